@@ -1,33 +1,134 @@
-import sys
+import sys, io
+import multiprocessing
 
 import checklist as cl
 import relation as rel
 import articulation as art
 import intension
+import delta
 import dribble
+import session
 from intension import choose_best_match
+from traversal import walk
 
 # For each B-record, we choose an articulation with the closest
 # A-record that it matches (preferably but not necessarily an '='
 # articulation).
 
-def align(B, A):
+# If B_root or A_root (a taxonID) is given, only that subtree of B or A
+# is aligned (see checklist.scope).
+# With processes > 1, matching and cross-mrcas are done by that many
+# worker processes.
+# If state (a dict) is given, the best matches and the intensional
+# proposal are put in it too, as "best" and "proposal" (see
+# incremental.save).
+# If A and B are versions of one source, source_delta can be the
+# delta.compare of their inputs (see presumed_matches).
+
+def align(B, A, session = None, B_root = None, A_root = None,
+          processes = 1, state = None, source_delta = None):
+  if session:
+    with session: return align(B, A, None, B_root, A_root, processes, state,
+                               source_delta)
+  if B_root: B = cl.scope(B, B_root)
+  if A_root: A = cl.scope(A, A_root)
+
+  # Some nodes are matched without searching
+  same = presumed_matches(A, B, source_delta)
 
   # Precompute all best matches
-  best = intension.best_intensional_match_map(B, A)
+  best = intension.best_intensional_match_map(B, A, processes, same)
 
   # Extensional analysis yields <= relationships between hierarchies
   # (written as the 'matches' relation ~)
-  xmrcas = infer_partners(best, A, B)
+  xmrcas = infer_partners(best, A, B, processes)
   dribble.log("# Number of cross-mrcas: %s" % len(xmrcas))
 
   # Turn tipward best matches into = or < articulations as appropriate
   proposal = intension.intensional_proposal(best, A, B)
 
   # Add extensional matches to a draft that already has intensional matches
-  the_alignment = propose_alignment(proposal, best, xmrcas)
+  the_alignment = propose_alignment(dict(proposal), best, xmrcas)
+  if state != None:
+    state["best"] = best
+    state["proposal"] = proposal
   return (the_alignment, xmrcas)
 
+# Best matches that aren't searched for: those between identical
+# subtrees, and if source_delta is given, those between records that
+# are unchanged from A to B.  Everything downstream of the best
+# matches is done as usual.
+
+def presumed_matches(A, B, source_delta = None):
+  matches = subtree_matches(A, B)
+  if source_delta != None:
+    unchanged_matches(A, B, source_delta, matches)
+  return matches
+
+# A and B are versions of one source, and source_delta is the
+# delta.compare of their inputs.  An accepted record that is unchanged
+# (by taxonID) is paired with itself, with reason "unchanged", unless
+# its taxonID is on more than one record on either side.  Adds to
+# matches, leaving the nodes already in it alone.
+
+def unchanged_matches(A, B, source_delta, matches):
+  (A_ids, B_ids) = (A.get_index(cl.taxon_id), B.get_index(cl.taxon_id))
+  count = 0
+  for (id, xs) in A_ids.items():
+    ys = B_ids.get(id)
+    if (ys and len(xs) == 1 and len(ys) == 1 and
+        source_delta.status(id) == delta.unchanged):
+      (x, y) = (xs[0], ys[0])
+      if (cl.is_accepted(x) and cl.is_accepted(y) and
+          not x in matches and not y in matches):
+        matches[x] = art.intensional(x, y, "unchanged")
+        matches[y] = art.intensional(y, x, "unchanged")
+        count += 1
+  dribble.log("# %s unchanged records paired" % count)
+
+# Pairs of identical subtrees, i.e. with equal subtree hashes (see
+# checklist.assign_subtree_hashes), going down from the roots of the
+# smaller of A and B.  Only a hash that occurs once in A and once in B
+# pairs two subtrees, so no pairing is a guess, and the pairs are the
+# same whichever side they're found from.  The nodes of paired subtrees
+# are paired in turn, by the same rule: children whose hash no sibling
+# shares are paired by their hashes, and siblings with equal hashes
+# (and their descendants) are left to the search.  Returns best
+# matches (~, as from the search, with reason "subtree") for the
+# paired nodes, both ways; everything downstream of the best matches
+# is done as usual.
+
+def subtree_matches(A, B):
+  if B.tnu_count() < A.tnu_count():
+    (A, B) = (B, A)
+  (A_nodes, B_nodes) = (A.get_hash_index(), B.get_hash_index())
+  matches = {}
+  def pre(x):
+    h = cl.get_subtree_hash(x)
+    y = B_nodes.get(h)
+    if y == None or A_nodes.get(h) != x:
+      return True
+    pairs = [(x, y)]
+    while pairs:
+      (u, v) = pairs.pop()
+      matches[u] = art.intensional(u, v, "subtree")
+      matches[v] = art.intensional(v, u, "subtree")
+      pairs += zip(unique_children(u), unique_children(v))
+    return False
+  walk(cl.get_roots(A), cl.get_children, pre = pre)
+  dribble.log("# %s nodes in identical subtrees" % len(matches))
+  return matches
+
+# Children whose subtree hash no sibling shares, in hash order
+
+def unique_children(node):
+  hashes = [(cl.get_subtree_hash(child), child)
+            for child in cl.get_children(node)]
+  counts = {}
+  for (h, child) in hashes:
+    counts[h] = counts.get(h, 0) + 1
+  return [child for (h, child) in sorted(hashes) if counts[h] == 1]
+
 # Side-affects proposal
 
 def propose_alignment(proposal, best, xmrcas):
@@ -40,43 +141,42 @@ def propose_alignment(proposal, best, xmrcas):
 # Store potential = and < relationships into the proposal
 
 def alignment_step(x, best, xmrcas, proposal):
+  # Walks rootward along both chains (a loop, not recursion, since
+  # chains can be as long as a lineage)
   def luup(x, y):
-    if x == cl.forest_tnu or y == cl.forest_tnu: return
-    assert cl.get_checklist(x) != cl.get_checklist(y)
-    if in_chain(x, y0) and in_chain(y, x0):
+    while x != cl.forest_tnu and y != cl.forest_tnu:
+      assert cl.get_checklist(x) != cl.get_checklist(y)
+      if not (in_chain(x, y0) and in_chain(y, x0)):
+        return
       bar = best.get(x)
       if bar and find_in_chain(bar.cod, y, x0):
         if bar.cod == y:
           art.proclaim(proposal, art.change_relation(bar, rel.eq, "extensional"))
-          luup(cl.get_parent(x), cl.get_parent(y))
+          (x, y) = (cl.get_parent(x), cl.get_parent(y))
         else:
           art.proclaim(proposal, art.extensional(y, x, rel.lt, "refines", "refined by"))
-          luup(x, cl.get_parent(y))
+          y = cl.get_parent(y)
       else:
         bar = best.get(y)
         if bar and find_in_chain(bar.cod, x, y0):
           if bar.cod == y:
             art.proclaim(proposal, bar)
-            luup(cl.get_parent(x), cl.get_parent(y))
+            (x, y) = (cl.get_parent(x), cl.get_parent(y))
           else:
             art.proclaim(proposal, art.extensional(x, y, rel.lt, "refines*", "refined by*"))
-            luup(cl.get_parent(x), y)
+            x = cl.get_parent(x)
         else:
           # neither x nor y matches by name
           art.proclaim(proposal, art.extensional(x, y, rel.eq, "similar="))
-          luup(cl.get_parent(x), cl.get_parent(y))
+          (x, y) = (cl.get_parent(x), cl.get_parent(y))
 
   # See is b is in the chain (matching nodes in lineage)
   def find_in_chain(b, y, x0):
-    if y == cl.forest_tnu:
-      return False
-    elif in_chain(y, x0):
+    while y != cl.forest_tnu and in_chain(y, x0):
       if b == y:
         return True
-      else:
-        return find_in_chain(b, cl.get_parent(y), x0)
-    else:
-      return False
+      y = cl.get_parent(y)
+    return False
 
   def in_chain(y, x0):
     ar = xmrcas.get(y)
@@ -96,35 +196,122 @@ def alignment_step(x, best, xmrcas, proposal):
 
 # ---------- Cross-MRCAs (partners) x <= y
 
-def infer_partners(best, A, B):
+# With processes > 1, each checklist's forest is cut into subtrees of
+# about equal size, whose cross-mrcas are found by forked worker
+# processes.  The levels above those subtrees are then done here, in
+# the same order as without workers, so the result is the same.
+
+def infer_partners(best, A, B, processes = 1):
+  if (processes > 1 and
+      "fork" in multiprocessing.get_all_start_methods()):
+    done = infer_partitions_in_parallel(best, [A, B], processes)
+  else:
+    done = {}
   xmrcas = {}
-  def half_infer_partners(checklist, other):
-    def subinfer_partners(x, other):
-      y = None
-      for child in cl.get_children(x):
-        child_ar = subinfer_partners(child, other) # an articulation
-        if child_ar != None:
-          child_y = child_ar.cod
-          if y == None:
-            y = child_y
-          else:
-            y = cl.mrca(y, child_y)
-      if y != None:
-        ar = art.extensional(x, y, rel.matches, "cross-mrca")
-      else:
-        ar = get_mutual(best, x)
-      if ar:
-        assert cl.get_checklist(ar.cod) != cl.get_checklist(x)
-        if dribble.watch(x):
-          dribble.log("# Cross-mrca: %s" % (art.express(ar)))
-        xmrcas[x] = ar
+  # A subtree with no best match anywhere in it has no cross-mrcas
+  matched = cl.lineages(best)
+  dribble_file = session.current().dribble_file
+  def half_infer_partners(checklist):
+    def subinfer_partners(x, child_ars):
+      if x in done:
+        # Subtree done by a worker
+        (entries, log) = done[x]
+        if dribble_file and log: dribble_file.write(log)
+        for (z, packed) in entries:
+          xmrcas[z] = best[z] if packed == None else art.unpack(packed)
+        return xmrcas.get(x)
+      ar = cross_mrca(x, child_ars, best)
+      if ar: xmrcas[x] = ar
       return ar             # in B
-    for root in cl.get_roots(checklist):
-      subinfer_partners(root, other)
-  half_infer_partners(A, B)
-  half_infer_partners(B, A)
+    walk(cl.get_roots(checklist), cl.get_children,
+         pre = lambda x: not x in done and x in matched,
+         post = subinfer_partners)
+  half_infer_partners(A)
+  half_infer_partners(B)
   return xmrcas
 
+def cross_mrca(x, child_ars, best):
+  y = None
+  for child_ar in child_ars:      # articulations
+    if child_ar != None:
+      child_y = child_ar.cod
+      # See cl.mrca about synonyms
+      assert cl.is_accepted(child_y)
+      if y == None:
+        y = child_y
+      else:
+        y = cl.mrca(y, child_y)
+  if y != None:
+    ar = art.extensional(x, y, rel.matches, "cross-mrca")
+  else:
+    ar = get_mutual(best, x)
+  if ar:
+    assert cl.get_checklist(ar.cod) != cl.get_checklist(x)
+    if dribble.watch(x):
+      dribble.log("# Cross-mrca: %s" % (art.express(ar)))
+  return ar
+
+# Maximal subtrees with at most size nodes (counting synonyms), in
+# preorder
+
+def partition(checklist, size):
+  roots = []
+  def pre(x):
+    if cl.get_subtree_size(x) <= size:
+      roots.append(x)
+      return False
+    return True
+  walk(cl.get_roots(checklist), cl.get_children, pre = pre)
+  return roots
+
+# Returns {root: (entries, log)} for the subtrees
+# done by the workers.  entries are (node, packed articulation) in
+# postorder, with None for a mutual best match.
+
+def infer_partitions_in_parallel(best, checklists, processes):
+  shards = []
+  for checklist in checklists:
+    size = max(1, checklist.tnu_count() // (4 * processes))
+    shard = []
+    count = 0
+    for x in partition(checklist, size):
+      shard.append(x)
+      count += cl.get_subtree_size(x)
+      if count >= size:
+        shards.append(shard)
+        (shard, count) = ([], 0)
+    if shard: shards.append(shard)
+  if len(shards) < 2: return {}
+  dribble_file = session.current().dribble_file
+  if dribble_file: dribble_file.flush()
+  global shard_best
+  shard_best = best
+  with multiprocessing.get_context("fork").Pool(processes) as pool:
+    results = pool.map(infer_partitions_in_shard, shards)
+  shard_best = None
+  done = {}
+  for (shard, shard_results) in zip(shards, results):
+    for (x, result) in zip(shard, shard_results):
+      done[x] = result
+  return done
+
+shard_best = None
+
+def infer_partitions_in_shard(roots):
+  results = []
+  for root in roots:
+    log = io.StringIO()
+    session.current().dribble_file = log
+    entries = []
+    def subinfer_partners(x, child_ars):
+      ar = cross_mrca(x, child_ars, shard_best)
+      if ar:
+        entries.append((x, None if ar is shard_best.get(x) else art.pack(ar)))
+      return ar
+    walk([root], cl.get_children, post = subinfer_partners)
+    results.append((entries, log.getvalue()))
+  return results
+
 def get_mutual(best, x):
   bar = best.get(x)
   if bar:
@@ -0,0 +1,117 @@
+# Reading inputs straight out of zip archives, without unpacking them.
+
+# Wherever an input file is expected, a path can also name
+#   dump.zip/names.dmp   the member names.dmp of the archive dump.zip
+#   backbone.zip         the core data file (taxon file) of a Darwin Core
+#                        archive, as given by the archive's meta.xml
+
+import io, csv, zipfile, contextlib
+import xml.etree.ElementTree as ElementTree
+
+# Returns (archive path, member name), or (None, path) if path isn't
+# in an archive.  member is None for the core of a Darwin Core archive.
+
+def split_path(path):
+  if path.lower().endswith(".zip"):
+    return (path, None)
+  i = path.lower().find(".zip/")
+  if i >= 0:
+    return (path[:i + 4], path[i + 5:])
+  return (None, path)
+
+def is_archived(path):
+  return split_path(path)[0] != None
+
+# The file (archive or not) that holds path's contents
+
+def container(path):
+  (zip_path, member) = split_path(path)
+  return zip_path or path
+
+# csv.reader parameters (delimiter, quotechar, quoting) for reading
+# path.  For the core of a Darwin Core archive they are the ones in
+# meta.xml; otherwise they go by the file name, as in
+# table.csv_parameters.
+
+def csv_parameters(path):
+  (zip_path, member) = split_path(path)
+  if zip_path != None and member == None:
+    with zipfile.ZipFile(zip_path) as zf:
+      (member, delimiter, quotechar, header) = find_core(zf)
+    if quotechar:
+      return (delimiter, quotechar, csv.QUOTE_MINIMAL)
+    return (delimiter, "\a", csv.QUOTE_NONE)
+  if ".csv" in member:
+    return (",", '"', csv.QUOTE_MINIMAL)
+  else:
+    return ("\t", "\a", csv.QUOTE_NONE)
+
+# Open path for reading as text.  The lines of a Darwin Core archive's
+# core always start with a header row, even if the file itself has
+# none (in which case the header is made from meta.xml).
+
+@contextlib.contextmanager
+def open_text(path):
+  (zip_path, member) = split_path(path)
+  if zip_path == None:
+    with open(path, "r") as infile:
+      yield infile
+    return
+  with zipfile.ZipFile(zip_path) as zf:
+    header = None
+    if member == None:
+      (member, delimiter, quotechar, header) = find_core(zf)
+    with zf.open(member) as raw:
+      stream = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+      if header == None:
+        yield stream
+      else:
+        yield with_header(delimiter.join(header) + "\n", stream)
+
+def with_header(line, stream):
+  yield line
+  yield from stream
+
+def members(zip_path):
+  with zipfile.ZipFile(zip_path) as zf:
+    return zf.namelist()
+
+# Core of a Darwin Core archive: (member, delimiter, quotechar,
+# header), where quotechar is None if fields aren't quoted, and header
+# is None if the file has a header row of its own, otherwise the
+# column names from meta.xml (the last part of each term URI).
+# The defaults are those of the Darwin Core text guide.
+
+def find_core(zf):
+  meta = ElementTree.fromstring(zf.read("meta.xml"))
+  core = None
+  for element in meta.iter():
+    if local_name(element) == "core":
+      core = element
+      break
+  if core == None:
+    raise ValueError("no core in meta.xml", zf.filename)
+  location = None
+  for element in core.iter():
+    if local_name(element) == "location":
+      location = element.text.strip()
+      break
+  delimiter = (core.get("fieldsTerminatedBy") or ",").replace("\\t", "\t")
+  quotechar = core.get("fieldsEnclosedBy", '"') or None
+  header = None
+  if core.get("ignoreHeaderLines", "0") == "0":
+    columns = {}
+    for element in core:
+      index = element.get("index")
+      if index == None: continue
+      if local_name(element) == "id":
+        columns[int(index)] = "taxonID"
+      elif local_name(element) == "field":
+        columns[int(index)] = element.get("term").rstrip("/").split("/")[-1]
+    header = [columns.get(i, "") for i in range(max(columns) + 1)]
+  return (location, delimiter, quotechar, header)
+
+# Tag without namespace
+
+def local_name(element):
+  return element.tag.split("}")[-1]
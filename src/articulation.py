@@ -6,22 +6,47 @@
 #   Composition
 #   Disjunction ??
 
-import collections
+import threading
 import relation as rel
 import checklist as cl
-import property
 import changes
 import dribble
+import session
 
 # Articulations
 
 # reason and factors are mutually exclusive.  reason is only for
 # non-composed articulations.
 
-Articulation = \
-  collections.namedtuple('Articulation',
-                         ['dom', 'cod', 'relation', 'factors',
-                          'reason', 'revreason', 'diff'])
+# Alignment creates a great many articulations, most of them
+# intermediates (from compose, reverse, set_relation) that are soon
+# dropped.  So they are kept small: reasons are interned and stored as
+# small ints, and diff - the record differences between dom and cod -
+# is only computed when someone asks for it, once per (dom, cod).
+
+class Articulation:
+  __slots__ = ('dom', 'cod', 'relation', 'factors',
+               'reason_code', 'revreason_code')
+
+  def __init__(self, dom, cod, relation, factors, reason, revreason):
+    self.dom = dom
+    self.cod = cod
+    self.relation = relation
+    self.factors = factors
+    self.reason_code = intern_reason(reason)
+    self.revreason_code = intern_reason(revreason)
+
+  @property
+  def reason(self):
+    return reasons[self.reason_code]
+
+  @property
+  def revreason(self):
+    return reasons[self.revreason_code]
+
+  @property
+  def diff(self):
+    return get_diff(self.dom, self.cod)
 
 def _articulation(dom, cod, re,
                   reason = None, revreason = None, factors = None):
@@ -29,13 +54,34 @@ def _articulation(dom, cod, re,
   assert cod > 0
   assert re
   assert re.name
-  dif = changes.all_diffs
-  if cl.is_accepted(dom) and cl.is_accepted(cod):
-    dif = changes.differences(dom, cod)
   assert reason or factors
   if reason and revreason == None: revreason = reason + " of"
-  ar = Articulation(dom, cod, re, factors, reason, revreason, dif)
-  return ar
+  return Articulation(dom, cod, re, factors, reason, revreason)
+
+# Interned reasons; code 0 is no reason.  These are shared by all
+# sessions, and so by all threads.
+
+reasons = [None]
+reason_codes = {None: 0}
+reasons_lock = threading.Lock()
+
+def intern_reason(reason):
+  code = reason_codes.get(reason)
+  if code == None:
+    with reasons_lock:
+      code = reason_codes.get(reason)
+      if code == None:
+        code = len(reasons)
+        reasons.append(reason)
+        reason_codes[reason] = code
+  return code
+
+# changes.differences remembers its comparisons
+
+def get_diff(dom, cod):
+  if cl.is_accepted(dom) and cl.is_accepted(cod):
+    return changes.differences(dom, cod)
+  return changes.all_diffs
 
 def express(ar):
   if ar == None:
@@ -111,6 +157,22 @@ def change_relation(ar, re, reason, revreason = reason):  # re = rel.gt
   return compose(set_relation(ar, re),
                  _articulation(ar.cod, ar.cod, rel.eq, reason, revreason))
 
+# Compact form for passing between processes, where reason codes mean
+# different things
+
+def pack(ar):
+  if ar == None: return None
+  return (ar.dom, ar.cod, ar.relation.name,
+          [pack(factor) for factor in ar.factors] if ar.factors else None,
+          ar.reason, ar.revreason)
+
+def unpack(packed):
+  if packed == None: return None
+  (dom, cod, name, factors, reason, revreason) = packed
+  return Articulation(dom, cod, rel.relations_by_name[name],
+                      [unpack(factor) for factor in factors] if factors else None,
+                      reason, revreason)
+
 # ---------- Synonymy relationship within one tree
 
 def synonymy(synonym, accepted):
@@ -174,27 +236,53 @@ def bridge(dom, cod, re, reason, revreason = None):
   return _articulation(dom, cod, re, reason=reason, revreason=revreason)
 
 # Intensional matches by name (no synonym following)
-# This ought to be cached I think?
 
 def direct_matches(node, other):
   assert node > 0
   assert cl.get_checklist(node) != other
-  seen = []
+  seen = set()
   arts = []
-  for prop in [cl.ncbi_id,
-               cl.eol_page_id,
-               cl.scientific_name,
-               cl.canonical_name,
-               cl.gbif_id]:
-    val = cl.get_value(node, prop)
-    if val != None:
-      more = cl.get_nodes_with_value(other, prop, val)
-      for hit in more:
-        if hit and not hit in seen:
-          seen.append(hit)
-          arts.append(intensional(node, hit, prop.pet_name))
+  for (prop, hits) in join(cl.get_checklist(node), other).get(node, ()):
+    for hit in hits:
+      if not hit in seen:
+        seen.add(hit)
+        arts.append(intensional(node, hit, prop.pet_name))
   return arts
 
+# Cross-checklist join on the match properties, computed once per
+# ordered pair of checklists by intersecting their value indexes.
+# Maps each node of checklist that has any match in other to a list of
+# (prop, nodes in other with the same value of prop), in
+# match_properties order.  Kept in the session.
+# The intersection goes through the smaller of the two indexes, so
+# joining a small checklist with a large one (either way round) costs
+# in proportion to the small one.
+
+def join(checklist, other):
+  joins = session.current().joins
+  j = joins.get((checklist, other))
+  if j == None:
+    j = {}
+    def add(nodes, hits):
+      for node in nodes:
+        if node in j:
+          j[node].append((prop, hits))
+        else:
+          j[node] = [(prop, hits)]
+    for prop in cl.match_properties:
+      here = cl.index_by_value(checklist, prop)
+      there = cl.index_by_value(other, prop)
+      if len(there) < len(here):
+        for (value, hits) in there.items():
+          nodes = here.get(value)
+          if nodes: add(nodes, hits)
+      else:
+        for (value, nodes) in here.items():
+          hits = there.get(value)
+          if hits: add(nodes, hits)
+    joins[(checklist, other)] = j
+  return j
+
 # ---------- Utility: collapsing a set of matches
 
 # Reduce a set of articulations grouped first by RCC5 relation, then
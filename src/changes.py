@@ -3,6 +3,12 @@ debug = False
 import table
 import property
 import checklist as cl
+import session
+
+try:
+  import numpy
+except ImportError:
+  numpy = None                  # batch_differences falls back to plain loops
 
 # Difference report, comparing two nodes.
 # The result is a "comparison" which is a triple (drop, change, add)
@@ -31,32 +37,100 @@ parentNameUsageID = property.by_name("parentNameUsageID")
 
 # TBD: filter out taxonID if idspaces are different
 
+# Comparisons are memoized per (uid1, uid2), in the session: the same
+# pair is compared while aligning, and again for each report that
+# mentions it.
+
 def differences(uid1, uid2, props = None):  # mask
-  (add, change, drop) = differences_in_record(uid1, uid2, props = None)
-  if len(cl.get_children(uid1)) != len(cl.get_children(uid2)):
-    change |= 1 << number_of_children.specificity
-  return (add, change, drop)
+  comparisons = session.current().comparisons
+  comparison = comparisons.get((uid1, uid2))
+  if comparison == None:
+    (drop, change, add) = differences_in_record(uid1, uid2, props = None)
+    if cl.count_children(uid1) != cl.count_children(uid2):
+      change |= 1 << number_of_children.specificity
+    comparison = (drop, change, add)
+    comparisons[(uid1, uid2)] = comparison
+  return comparison
 
 def differences_in_record(uid1, uid2, props = None):  # mask
+  t1 = table.get_table(uid1)
+  t2 = table.get_table(uid2)
   if props == None:
-    props = table.get_table(uid2).properties
+    (pairs, same_layout) = get_column_pairs(t1, t2)
+    # Identical fingerprints mean identical records
+    if same_layout and (get_fingerprints(t1)[uid1 - t1.uid_offset] ==
+                        get_fingerprints(t2)[uid2 - t2.uid_offset]):
+      return no_diffs
+  else:
+    pairs = column_pairs(t1, t2, props)
+  local1 = uid1 - t1.uid_offset
+  local2 = uid2 - t2.uid_offset
   drop = 0
   change = 0
   add = 0
-  for prop in props:
-    if prop and prop != taxonID and prop != parentNameUsageID:
-      v1 = cl.get_value(uid1, prop)
-      v2 = cl.get_value(uid2, prop)
-      if v1 != v2:
-        if v1 == None:
-          add |= 1 << prop.specificity
-        elif v2 == None:
-          drop |= 1 << prop.specificity
-        else:
-          change |= 1 << prop.specificity
+  for (bit, column1, column2) in pairs:
+    v1 = column1.get(local1) if column1 else None
+    v2 = column2.get(local2) if column2 else None
+    if v1 != v2:
+      if v1 == None:
+        add |= bit
+      elif v2 == None:
+        drop |= bit
+      else:
+        change |= bit
   # TBD: compare parents ??
   return (drop, change, add)
 
+# The properties that get compared
+
+def compared_properties(props):
+  return [prop for prop in props
+          if prop and prop != taxonID and prop != parentNameUsageID]
+
+# For each compared property, its bit and the column holding it on
+# either side (None if that side doesn't have it).
+
+def column_pairs(t1, t2, props):
+  pairs = []
+  seen = set()
+  for prop in compared_properties(props):
+    if not prop in seen:
+      seen.add(prop)
+      pairs.append((1 << prop.specificity,
+                    t1.columns[prop.uid], t2.columns[prop.uid]))
+  return pairs
+
+# Session's column_pairs maps (t1, t2) ->
+#   (column pairs for t2's properties,
+#    whether fingerprints of t1 and t2 are comparable)
+
+def get_column_pairs(t1, t2):
+  table_pairs = session.current().column_pairs
+  entry = table_pairs.get((t1, t2))
+  if entry == None:
+    entry = (column_pairs(t1, t2, t2.properties),
+             compared_properties(t1.properties) ==
+             compared_properties(t2.properties))
+    table_pairs[(t1, t2)] = entry
+  return entry
+
+# Record fingerprints: a hash, for each record, of its values for the
+# compared properties.  Records of two tables that have the same
+# compared properties in the same order can be checked for equality by
+# comparing fingerprints.  (These are not stable from one process to
+# the next, so they aren't kept in snapshots.)
+
+def get_fingerprints(t):
+  fingerprints = session.current().fingerprints
+  fps = fingerprints.get(t)
+  if fps == None:
+    columns = [t.columns[prop.uid] for prop in compared_properties(t.properties)]
+    fps = [None] + [hash(tuple(column.get(local) if column else None
+                               for column in columns))
+                    for local in range(1, len(t.record_uids) + 1)]
+    fingerprints[t] = fps
+  return fps
+
 number_of_children = property.by_name("number_of_children")
 number_of_synonyms = property.by_name("number_of_synonyms")
 
@@ -79,3 +153,139 @@ def unpack1(mask):
     if (mask & (1 << spec)) != 0:
       props.append(prop)
   return props
+
+# ---------- Many comparisons at once
+
+# Compare each of a list of (uid1, uid2) pairs, as differences does,
+# and remember the results.  Returns three lists of masks (drop,
+# change, add), parallel to pairs.
+
+# Values are compared by their codes in the columns' dictionaries:
+# uid1's codes are translated into the codes that uid2's column uses
+# for the same values, so that each property takes one comparison of
+# code vectors for all the pairs.  This uses numpy if it's installed.
+
+def batch_differences(pairs):
+  drops = [0] * len(pairs)
+  changes = [0] * len(pairs)
+  adds = [0] * len(pairs)
+  groups = {}
+  for (i, (uid1, uid2)) in enumerate(pairs):
+    key = (table.get_table(uid1), table.get_table(uid2))
+    groups.setdefault(key, []).append(i)
+  for ((t1, t2), indexes) in groups.items():
+    locals1 = [pairs[i][0] - t1.uid_offset for i in indexes]
+    locals2 = [pairs[i][1] - t2.uid_offset for i in indexes]
+    compare = compare_with_numpy if numpy else compare_in_python
+    (d, c, a) = compare(t1, t2, locals1, locals2)
+    for (j, i) in enumerate(indexes):
+      drops[i] = d[j]
+      changes[i] = c[j]
+      adds[i] = a[j]
+  comparisons = session.current().comparisons
+  for (i, pair) in enumerate(pairs):
+    comparisons[pair] = (drops[i], changes[i], adds[i])
+  return (drops, changes, adds)
+
+no_code = 0xFFFFFFFF            # value not in the other column
+
+# Returns (translation, codes1, codes2).  translation maps codes of
+# column1 to codes of column2 (no_code if the value doesn't occur
+# there); codes1 and codes2 are None for a missing column.
+
+def code_vectors(column1, column2):
+  if column1: column1 = get_materialized(column1)
+  if column2: column2 = get_materialized(column2)
+  if column1 == None:
+    translation = [0]
+  elif column2 == None:
+    translation = [0] + [no_code] * (len(column1.values) - 1)
+  else:
+    translation = [0] + [column2.codes_by_value.get(value, no_code)
+                         for value in column1.values[1:]]
+  return (translation,
+          column1 and column1.codes,
+          column2 and column2.codes)
+
+# A memory-mapped column (see table.MappedColumn) is decoded into an
+# ordinary one once per session, not once per batch
+
+def get_materialized(column):
+  materialized = session.current().materialized
+  result = materialized.get(column)
+  if result == None:
+    result = column.materialize()
+    materialized[column] = result
+  return result
+
+def compare_in_python(t1, t2, locals1, locals2):
+  n = len(locals1)
+  drop = [0] * n
+  change = [0] * n
+  add = [0] * n
+  (pairs, _) = get_column_pairs(t1, t2)
+  for (bit, column1, column2) in pairs:
+    (translation, codes1, codes2) = code_vectors(column1, column2)
+    for j in range(n):
+      c1 = translation[codes1[locals1[j]]] if codes1 else 0
+      c2 = codes2[locals2[j]] if codes2 else 0
+      if c1 != c2:
+        if c1 == 0:
+          add[j] |= bit
+        elif c2 == 0:
+          drop[j] |= bit
+        else:
+          change[j] |= bit
+  counts1 = get_child_counts(t1)
+  counts2 = get_child_counts(t2)
+  bit = 1 << number_of_children.specificity
+  for j in range(n):
+    if counts1[locals1[j]] != counts2[locals2[j]]:
+      change[j] |= bit
+  return (drop, change, add)
+
+def compare_with_numpy(t1, t2, locals1, locals2):
+  assert property.number_of_properties < 63    # masks are int64
+  n = len(locals1)
+  locals1 = numpy.array(locals1, dtype=numpy.intp)
+  locals2 = numpy.array(locals2, dtype=numpy.intp)
+  drop = numpy.zeros(n, dtype=numpy.int64)
+  change = numpy.zeros(n, dtype=numpy.int64)
+  add = numpy.zeros(n, dtype=numpy.int64)
+  zeros = numpy.zeros(n, dtype=numpy.uint32)
+  (pairs, _) = get_column_pairs(t1, t2)
+  for (bit, column1, column2) in pairs:
+    (translation, codes1, codes2) = code_vectors(column1, column2)
+    c1 = zeros
+    if codes1:
+      translation = numpy.array(translation, dtype=numpy.uint32)
+      c1 = translation[numpy.frombuffer(codes1, dtype=numpy.uint32)[locals1]]
+    c2 = numpy.frombuffer(codes2, dtype=numpy.uint32)[locals2] if codes2 else zeros
+    differ = c1 != c2
+    added = differ & (c1 == 0)
+    dropped = differ & (c2 == 0) & ~added
+    add[added] |= bit
+    drop[dropped] |= bit
+    change[differ & ~added & ~dropped] |= bit
+  counts1 = numpy.asarray(get_child_counts(t1))[locals1]
+  counts2 = numpy.asarray(get_child_counts(t2))[locals2]
+  change[counts1 != counts2] |= 1 << number_of_children.specificity
+  return (drop.tolist(), change.tolist(), add.tolist())
+
+# Number of children of each record, by local number
+
+def get_child_counts(t):
+  child_counts = session.current().child_counts
+  if not t in child_counts:
+    n = len(t.record_uids)
+    if numpy:
+      parents = numpy.frombuffer(t.parents, dtype=numpy.uint32)[1:]
+      parents = parents[parents != 0].astype(numpy.intp) - t.uid_offset
+      counts = numpy.bincount(parents, minlength=n + 1)
+    else:
+      counts = [0] * (n + 1)
+      for parent in t.parents[1:]:
+        if parent:
+          counts[parent - t.uid_offset] += 1
+    child_counts[t] = counts
+  return child_counts[t]
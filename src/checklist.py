@@ -1,6 +1,7 @@
 debug = False
 
-import os, csv
+import os, csv, hashlib
+from array import array
 
 import relation as rel
 import rank
@@ -8,6 +9,9 @@ import chaitin
 import property
 import table
 import dribble
+import snapshot
+import archive
+from traversal import walk
 
 # ---------- Fields (columns, properties) in taxon table
 
@@ -30,6 +34,20 @@ ncbi_id      = field("ncbi_id")
 gbif_id      = field("gbif_id")
 eol_page_id  = field("EOLid")
 
+# The fields that articulation.direct_matches looks up by value, in
+# order of preference
+
+match_properties = [ncbi_id, eol_page_id, scientific_name, canonical_name,
+                    gbif_id]
+
+# The fields that alignment consults.  Reading only these (see
+# read_checklist) saves memory on wide inputs.
+
+alignment_properties = [nomenclatural_status, taxonomic_status, taxon_rank,
+                        parent_taxon_id, taxon_id, accepted_taxon_id,
+                        canonical_name, scientific_name,
+                        ncbi_id, gbif_id, eol_page_id]
+
 # ---------- Taxon registry and taxa
 
 forest_tnu = 0
@@ -51,12 +69,13 @@ def get_checklist(uid):
 # ---------- Checklists
 
 class Checklist(table.Table):
-  def __init__(self, prefix, name):
-    super().__init__()
+  def __init__(self, prefix, name, projection = None):
+    super().__init__(projection)
     assert prefix
     self.prefix = prefix
     self.name = name    # not used?
-    self.sequence_numbers = {}
+    self.roots = None
+    self.hash_index = None
 
   def get_all_nodes(self):
     return self.record_uids
@@ -64,49 +83,339 @@ class Checklist(table.Table):
   def tnu_count(self):
     return len(self.record_uids)
 
+  # Topology, computed once after loading.  Each array is indexed by
+  # local record number and holds uids (0 = none).  Children and
+  # synonyms are linked lists threaded through next_sibling and
+  # next_synonym, in uid order.
+
+  def build_topology(self):
+    n = len(self.record_uids)
+    self.parents = self.resolve_links(parent_taxon_id)
+    self.accepteds = self.resolve_links(accepted_taxon_id)
+    self.first_child = array('I', [0]) * (n + 1)
+    self.next_sibling = array('I', [0]) * (n + 1)
+    self.first_synonym = array('I', [0]) * (n + 1)
+    self.next_synonym = array('I', [0]) * (n + 1)
+    offset = self.uid_offset
+    for local in range(n, 0, -1):
+      uid = offset + local
+      parent = self.parents[local]
+      if parent:
+        self.next_sibling[local] = self.first_child[parent - offset]
+        self.first_child[parent - offset] = uid
+      accepted = self.accepteds[local]
+      if accepted:
+        self.next_synonym[local] = self.first_synonym[accepted - offset]
+        self.first_synonym[accepted - offset] = uid
+
+  # For each record, the uid of the (first) record whose taxonID is
+  # the value of the given field.  Each distinct value is looked up once.
+
+  def resolve_links(self, field):
+    column = self.columns[field.uid]
+    if column == None:
+      return array('I', [0]) * (len(self.record_uids) + 1)
+    ids = self.get_index(taxon_id)
+    def resolve(value):
+      uids = ids.get(value)
+      return uids[0] if uids else 0
+    return column.map_to_ints(resolve)
+
+  # Preorder numbering.  The descendants of a node (including
+  # synonyms) are numbered from its own number up to its entry in
+  # last_sequence_numbers, so ancestry is an interval test.
+  # nodes_by_sequence is the inverse of sequence_numbers.
+
   def assign_sequence_numbers(self):
-    n = len(self.sequence_numbers)    # dict
-    def process(tnu, n):
+    self.sequence_numbers = array('i', [-1]) * (len(self.record_uids) + 1)
+    self.last_sequence_numbers = array('i', [-1]) * (len(self.record_uids) + 1)
+    self.nodes_by_sequence = array('I')
+    offset = self.uid_offset
+    count = [0]
+    def number(tnu):
       assert tnu > 0
-      self.sequence_numbers[tnu] = n
-      n = n + 1
-      for inf in get_raw_children(tnu):
-        n = process(inf, n)
-      for inf in get_raw_synonyms(tnu):
-        n = process(inf, n)
-      return n
-    for root in get_roots(self):
-      n = process(root, n)
+      self.sequence_numbers[tnu - offset] = count[0]
+      self.nodes_by_sequence.append(tnu)
+      count[0] += 1
+    def close(tnu, results):
+      self.last_sequence_numbers[tnu - offset] = count[0] - 1
+    walk(get_roots(self),
+         lambda tnu: get_raw_children(tnu) + get_raw_synonyms(tnu),
+         number, close)
+
+  # Binary lifting table for mrca: jumps[k] holds, for each record,
+  # its 2^k-th ancestor (0 = forest).  Uses parents, so synonyms
+  # (which have no parent) map to 0 throughout.
+
+  def build_ancestry_index(self):
+    offset = self.uid_offset
+    jump = self.parents
+    self.jumps = [jump]
+    while True:
+      jump = array('I', (jump[up - offset] if up else 0 for up in jump))
+      if not any(jump): break
+      self.jumps.append(jump)
+
+  # Mutex (rank level, see rank.py) of every node; higher numbers are
+  # more tipward.  A root is rank.root.  Otherwise the given rank, if
+  # any, is normative; failing that a node is put ten levels rootward of
+  # its most rootward child.  Then, going down from the roots, any child
+  # that isn't tipward of its parent is demoted.  Synonyms get their
+  # accepted node's mutex.  Given roots, only their subtrees are
+  # (re)done, as if the roots had no parents (see Scope).
+
+  def assign_mutexes(self, roots = None):
+    offset = self.uid_offset
+    if roots == None:
+      roots = get_roots(self)
+      mutexes = array('i', [0]) * (len(self.record_uids) + 1)
+    else:
+      mutexes = array('i', self.mutexes)
+    root_set = set(roots)
+    def estimate(tnu, child_mutexes):
+      if tnu in root_set:
+        mutex = rank.root
+      else:
+        mutex = (get_nominal_mutex(tnu) or
+                 min([rank.atom] + child_mutexes) - 10)
+      assert mutex >= 0
+      mutexes[tnu - offset] = mutex
+      return mutex
+    def correct(parent):
+      parent_mutex = mutexes[parent - offset]
+      for child in get_raw_children(parent):
+        child_mutex = mutexes[child - offset]
+        if child_mutex <= parent_mutex:
+          report_rank_inversion(child, parent, child_mutex == parent_mutex)
+          if is_container(child):
+            mutex = parent_mutex + 1
+          else:
+            mutex = parent_mutex + 10
+          report_mutex_change(child, child_mutex, mutex)
+          mutexes[child - offset] = mutex
+      for synonym in get_raw_synonyms(parent):
+        mutexes[synonym - offset] = parent_mutex
+    walk(roots, get_raw_children, post = estimate)
+    walk(roots, get_raw_children, pre = correct)
+    self.mutexes = mutexes
+
+  # Merkle-style hashes, 16 bytes per record in subtree_hashes.  An
+  # accepted node's hash covers its own values, its synonyms' hashes
+  # and its children's hashes, so two subtrees (in any two checklists)
+  # with the same hash have the same records in the same shape.  The
+  # taxonIDs that records are identified and linked by are left out,
+  # as are the orders of children and of synonyms.  A synonym's hash
+  # covers just its own values.
+
+  def assign_subtree_hashes(self):
+    offset = self.uid_offset
+    hashes = bytearray(16 * (len(self.record_uids) + 1))
+    columns = {}
+    for prop in self.properties:
+      if prop and not prop in (taxon_id, parent_taxon_id, accepted_taxon_id):
+        column = self.columns[prop.uid]
+        if column != None: columns[prop] = column
+    columns = [(prop.pet_name, columns[prop])
+               for prop in sorted(columns, key=lambda prop: prop.uid)]
+    def record_hash(local):
+      h = hashlib.blake2b(digest_size=16)
+      for (pet_name, column) in columns:
+        value = column.get(local)
+        if value != None:
+          h.update(("%s\x1e%s\x1f" % (pet_name, value)).encode("utf-8"))
+      return h
+    def store(local, digest):
+      hashes[16 * local : 16 * local + 16] = digest
+      return digest
+    def finish(tnu, child_hashes):
+      h = record_hash(tnu - offset)
+      h.update(b"\x1d")
+      for digest in sorted(child_hashes):
+        h.update(digest)
+      h.update(b"\x1d")
+      for digest in sorted(store(synonym - offset,
+                                 record_hash(synonym - offset).digest())
+                           for synonym in get_raw_synonyms(tnu)):
+        h.update(digest)
+      return store(tnu - offset, h.digest())
+    walk(get_roots(self), get_raw_children, post = finish)
+    self.subtree_hashes = hashes
+
+  # Subtree hash -> accepted node with that hash, or None if more than
+  # one node has it.  Built on first use and kept, so a checklist
+  # compared many times (see server.py) pays for it once.
+
+  def get_hash_index(self):
+    if self.hash_index == None:
+      nodes = {}
+      for node in self.get_all_nodes():
+        if is_accepted(node):
+          h = get_subtree_hash(node)
+          nodes[h] = None if h in nodes else node
+      self.hash_index = nodes
+    return self.hash_index
+
+# ---------- Scopes
+
+# A Scope is a view of the subtree of a checklist below a given
+# (accepted) root.  It shares the checklist's columns and topology,
+# except that the root has no parent, and its get_all_nodes and indexes
+# cover only the subtree.  scope() puts it in the current session's
+# registry in place of the checklist, so that everything that finds a
+# checklist from a node - traversal, matching, mrca, merging, reports -
+# sees the subtree as a whole checklist.  So a checklist and a scope
+# of it can't be used together in one session.
+
+class Scope(Checklist):
+  def __init__(self, checklist, root):
+    assert is_accepted(root)
+    self.__dict__.update(checklist.__dict__)
+    self.checklist = checklist
+    self.root = root
+    offset = self.uid_offset
+    self.first_sequence_number = self.sequence_numbers[root - offset]
+    self.last_sequence_number = self.last_sequence_numbers[root - offset]
+    self.nodes = sorted(self.nodes_by_sequence[self.first_sequence_number:
+                                               self.last_sequence_number + 1])
+    self.parents = array('I', checklist.parents)
+    self.parents[root - offset] = 0
+    # The root's mutex, and so maybe its descendants', is as it
+    # would be in a checklist of just this subtree
+    self.assign_mutexes([root])
+    self.scope_indexes = {}
+    self.roots = [root]
+    self.hash_index = None
 
-# Sequence number within this checklist
+  def get_all_nodes(self):
+    return self.nodes
 
-def get_sequence_number(uid):
-  return get_checklist(uid).sequence_numbers[uid]
+  def tnu_count(self):
+    return len(self.nodes)
+
+  def get_index(self, prop):
+    index = self.scope_indexes.get(prop)
+    if index == None:
+      index = {}
+      column = self.columns[prop.uid]
+      if column != None:
+        offset = self.uid_offset
+        for uid in self.nodes:
+          value = column.get(uid - offset)
+          if value != None:
+            if value in index:
+              index[value].append(uid)
+            else:
+              index[value] = [uid]
+      self.scope_indexes[prop] = index
+    return index
+
+# Restrict checklist (in the current session) to the subtree whose
+# root has the given taxonID
+
+def scope(checklist, root_id):
+  return use_scope(make_scope(checklist, root_id))
+
+# A Scope that isn't yet in any session's registry.  It can be put in
+# place with use_scope in any session that has its checklist, as many
+# times as needed (see server.py).
+
+def make_scope(checklist, root_id):
+  if isinstance(checklist, Scope):
+    checklist = checklist.checklist
+  uids = checklist.get_index(taxon_id).get(root_id)
+  if not uids:
+    raise ValueError("no taxon with this taxonID", root_id)
+  return Scope(checklist, to_accepted(uids[0]))
+
+def use_scope(view):
+  table._substitute(view.checklist, view)
+  dribble.log("# Restricted %s to %s (%s nodes)" %
+              (view.prefix, get_unique(view.root), len(view.nodes)))
+  return view
 
-# Read a checklist from a file
+# Sequence number within this checklist
 
-def read_checklist(specifier, prefix, name):
+def get_sequence_number(uid):
+  checklist = get_checklist(uid)
+  return checklist.sequence_numbers[uid - checklist.uid_offset]
+
+# Number of nodes (including synonyms) in the subtree rooted at uid
+
+def get_subtree_size(uid):
+  checklist = get_checklist(uid)
+  offset = checklist.uid_offset
+  return (checklist.last_sequence_numbers[uid - offset] -
+          checklist.sequence_numbers[uid - offset] + 1)
+
+# See Checklist.assign_subtree_hashes
+
+def get_subtree_hash(uid):
+  checklist = get_checklist(uid)
+  local = uid - checklist.uid_offset
+  return bytes(checklist.subtree_hashes[16 * local : 16 * local + 16])
+
+# True if the subtrees rooted at x and y (usually in different
+# checklists) have the same records in the same shape
+
+def same_subtree(x, y):
+  return get_subtree_hash(x) == get_subtree_hash(y)
+
+# Read a checklist from a file.
+# If cache is true, reuse (or else write) a snapshot of the loaded
+# checklist stored next to the file.
+# If mapped is true, a TSV file is memory-mapped (see table.MappedColumn).
+# If projection is given, only those properties are kept.
+# The indexes used for topology and matching are built in one pass
+# over the records, in a background thread if background is true.
+# The checklist goes into the given session, or else the current one.
+
+def read_checklist(specifier, prefix, name, cache = False, mapped = False,
+                   projection = None, background = False, session = None):
+  if session:
+    with session:
+      return read_checklist(specifier, prefix, name, cache, mapped,
+                            projection, background)
   assert prefix
-  checklist = Checklist(prefix, name)
+  if specifier.endswith(')'):
+    cache = False
+  elif cache:
+    checklist = snapshot.load(specifier, prefix, name, projection)
+    if checklist: return checklist
+  checklist = Checklist(prefix, name, projection)
   if specifier.endswith(')'):
     checklist.populate_from_generator(chaitin.parse(specifier))
   else:
-    checklist.populate_from_file(specifier)
+    checklist.populate_from_file(specifier, mapped)
 
   assert checklist.get_position(canonical_name) != None
   if checklist.get_position(taxon_id) == None:
     print (checklist.header())
     assert False
 
+  if cache or not background:
+    checklist.build_indexes([taxon_id] + match_properties)
+  checklist.build_topology()
   validate(checklist)
   checklist.assign_sequence_numbers()
+  checklist.build_ancestry_index()
+  checklist.assign_mutexes()
+  checklist.assign_subtree_hashes()
+  if cache:
+    snapshot.save(checklist, specifier)
+  elif background:
+    checklist.start_indexing(match_properties)
 
   return checklist
 
 # Utility - copied from another file - really ought to be shared
 # Is this used?  Could be
+# dwca_dir can also be a zip file (see archive.py).
 
 def get_nodes_file_path(dwca_dir):
+  if archive.is_archived(dwca_dir):
+    names = archive.members(dwca_dir)
+    if "meta.xml" in names:
+      return dwca_dir
   for name in ["taxon.tsv",
                "Taxon.tsv",
                "taxon.tab",
@@ -115,7 +424,10 @@ def get_nodes_file_path(dwca_dir):
                "taxon.txt",
                "Taxon.txt"]:
     path = os.path.join(dwca_dir, name)
-    if os.path.exists(path):
+    if archive.is_archived(dwca_dir):
+      if name in names:
+        return path
+    elif os.path.exists(path):
       return path
   raise ValueError("cannot find taxon file in this directory", dwca_dir)
 
@@ -190,15 +502,28 @@ def get_unique(tnu):
   else:
     return get_spaceless(tnu)
 
-# Roots - accepted tnus without parents
+# Roots - accepted tnus without parents.  The topology doesn't change
+# once it's built, so they're found once per checklist and kept.
 
 def get_roots(checklist):
-  roots = []
-  for tnu in checklist.get_all_nodes():
-    assert tnu > 0
-    if is_accepted(tnu) and get_parent(tnu) == forest_tnu:
-      roots.append(tnu)
-  return roots
+  if checklist.roots == None:
+    roots = []
+    for tnu in checklist.get_all_nodes():
+      assert tnu > 0
+      if is_accepted(tnu) and get_parent(tnu) == forest_tnu:
+        roots.append(tnu)
+    checklist.roots = roots
+  return checklist.roots
+
+def count_children(parent):
+  checklist = get_checklist(parent)
+  offset = checklist.uid_offset
+  count = 0
+  child = checklist.first_child[parent - offset]
+  while child:
+    count += 1
+    child = checklist.next_sibling[child - offset]
+  return count
 
 # ----------
 # Parent/children and accepted/synonyms
@@ -214,10 +539,8 @@ def get_parent(tnu):
     return forest_tnu
 
 def get_raw_parent(node):
-  parent_id = get_value(node, parent_taxon_id)
-  if parent_id != None:
-    return get_record_with_taxon_id(get_checklist(node), parent_id)
-  return None
+  checklist = get_checklist(node)
+  return checklist.parents[node - checklist.uid_offset] or None
 
 def get_children(parent):
   children = get_raw_children(parent)
@@ -228,9 +551,14 @@ def get_children(parent):
   return children
 
 def get_raw_children(parent):
-  return get_nodes_with_value(get_checklist(parent),
-                              parent_taxon_id,
-                              get_taxon_id(parent))
+  checklist = get_checklist(parent)
+  offset = checklist.uid_offset
+  children = []
+  child = checklist.first_child[parent - offset]
+  while child:
+    children.append(child)
+    child = checklist.next_sibling[child - offset]
+  return children
 
 # ----------
 # Accepted/synonyms
@@ -242,11 +570,8 @@ def get_accepted(tnu):
   return get_raw_accepted(tnu)
 
 def get_raw_accepted(tnu):
-  probe = get_value(tnu, accepted_taxon_id)
-  if probe != None:
-    return get_record_with_taxon_id(get_checklist(tnu), probe)
-  else:
-    return None
+  checklist = get_checklist(tnu)
+  return checklist.accepteds[tnu - checklist.uid_offset] or None
 
 def get_synonyms(tnu):
   syns = get_raw_synonyms(tnu)
@@ -257,10 +582,14 @@ def get_synonyms(tnu):
   return syns
 
 def get_raw_synonyms(tnu):
-  return get_nodes_with_value(get_checklist(tnu),
-                              accepted_taxon_id,
-                              get_taxon_id(tnu))
-  # return [syn for syn in ...]
+  checklist = get_checklist(tnu)
+  offset = checklist.uid_offset
+  synonyms = []
+  syn = checklist.first_synonym[tnu - offset]
+  while syn:
+    synonyms.append(syn)
+    syn = checklist.next_synonym[syn - offset]
+  return synonyms
 
 def get_taxonomic_status(tnu):
   return get_value(tnu, taxonomic_status)
@@ -268,13 +597,10 @@ def get_taxonomic_status(tnu):
 def get_nomenclatural_status(tnu):
   return get_value(tnu, nomenclatural_status)
 
+# validate checks that synonyms have no children or synonyms
+
 def is_accepted(tnu):
-  if get_value(tnu, accepted_taxon_id):
-    assert get_raw_children(tnu) == []
-    assert get_raw_synonyms(tnu) == []
-    return False
-  else:
-    return True
+  return not get_value(tnu, accepted_taxon_id)
 
 # Get canonical record among a set of equivalent records
 
@@ -330,6 +656,9 @@ def is_synonym_status(status):
 
 # ---------- Hierarchy analyzers
 
+# how_related, are_disjoint and mrca go by the tree itself (the
+# ancestry index), not by climbing through mutexes as they once did.
+
 def how_related(tnu1, tnu2):
   if tnu1 == tnu2:
     # If in differently checklists, this could be an incompatibility
@@ -337,11 +666,13 @@ def how_related(tnu1, tnu2):
   assert table.is_record(tnu1)
   assert table.is_record(tnu2)
   assert get_checklist(tnu1) == get_checklist(tnu2)
-  (peer1, peer2) = find_peers(tnu1, tnu2)  
-  if peer1 == peer2:
-    if peer1 == tnu1:
+  acc1 = to_accepted(tnu1)
+  acc2 = to_accepted(tnu2)
+  # A synonym is never < or > its own accepted node
+  if acc1 != acc2:
+    if acc1 == tnu1 and is_ancestor(acc1, acc2):
       return rel.gt
-    elif peer2 == tnu2:
+    elif acc2 == tnu2 and is_ancestor(acc2, acc1):
       return rel.lt
   return rel.disjoint
 
@@ -351,138 +682,86 @@ def are_disjoint(tnu1, tnu2):
   if tnu1 == forest_tnu: return False
   if tnu2 == forest_tnu: return False
   if tnu1 == tnu2: return False
-  (tnu1, tnu2) = find_peers(tnu1, tnu2)
-  return tnu1 != tnu2
-
-# Find ancestor(s) of tnu1 and/or tnu2 that are in the same mutex: either
-# disjoint or equal.
-
-def find_peers(tnu_1, tnu_2):
-  assert table.is_record(tnu_1)
-  assert table.is_record(tnu_2)
-
-  tnu1 = to_accepted(tnu_1)
-  tnu2 = to_accepted(tnu_2)
-
-  if tnu1 == forest_tnu or tnu2 == forest_tnu:
-    return (forest_tnu, forest_tnu)
-  assert get_checklist(tnu1) == get_checklist(tnu2)  #?
-
-  mutex1 = get_mutex(tnu1)
-  mutex2 = get_mutex(tnu2)
-
-  if mutex1 == mutex2:
-    if debug:
-      print ("# Kludge %s %s" % (get_unique(tnu1), get_unique(tnu2)))
-    tnu1 = get_parent(tnu1)
-    mutex1 = get_mutex(tnu1)    
-
-  #print("# Mutexes are %s %s" % (mutex1, mutex2))
-  # Mutex of the forest is 0.  Going in 0-ward direction.
-
-  while mutex1 != mutex2:
-    assert mutex1 >= 0
-    assert mutex2 >= 0
-    if mutex1 > mutex2:
-      # If p2 is closer to the root, try going rootward from p1
-      if tnu1 == forest_tnu: return (forest_tnu, forest_tnu)
-      tnu1 = get_parent(tnu1)
-      mutex1 = get_mutex(tnu1)
-    else: # mutex1 < mutex2:
-      # If p1 is closer to the root, try going rootward from p2
-      if tnu2 == forest_tnu: return (forest_tnu, forest_tnu)
-      tnu2 = get_parent(tnu2)
-      mutex2 = get_mutex(tnu2)
-
-  if debug:
-   print("# find_peers(%s, %s) = %s, %s" % \
-        (get_unique(tnu_1), get_unique(tnu_2), 
-         get_unique(tnu1), get_unique(tnu2)))
-  return (tnu1, tnu2)
+  tnu1 = to_accepted(tnu1)
+  tnu2 = to_accepted(tnu2)
+  return not (is_ancestor(tnu1, tnu2) or is_ancestor(tnu2, tnu1))
+
+# Ancestor-or-self test, in constant time, using the preorder intervals.
+# tnu1 should be accepted (a synonym is an ancestor only of itself).
+
+def is_ancestor(tnu1, tnu2):
+  checklist = get_checklist(tnu1)
+  offset = checklist.uid_offset
+  n = checklist.sequence_numbers[tnu1 - offset]
+  return n <= checklist.sequence_numbers[tnu2 - offset] <= \
+    checklist.last_sequence_numbers[tnu1 - offset]
 
 # Common ancestor - utility
 # Also computes number of matched tips
 # None (not 0) is the identity for mrca
+# The lowest common ancestor of the accepted nodes, found with the
+# ancestry index (see above).  A synonym stands for its accepted node,
+# so the mrca of a synonym and its accepted node is the accepted node.
+# (When mrca climbed through mutexes, it was the accepted node's
+# parent.  alignment.cross_mrca, the one caller, passes only accepted
+# nodes, and checks that it does.)
 
 def mrca(tnu1, tnu2):
-  while True:
-    if tnu1 == forest_tnu: return forest_tnu
-    if tnu2 == forest_tnu: return forest_tnu
-    assert table.is_record(tnu1)
-    assert table.is_record(tnu2)
-    # to_accepted ??
-    if tnu1 == tnu2: return tnu1
-    (tnu1, tnu2) = find_peers(tnu1, tnu2)
-    assert get_mutex(tnu1) == get_mutex(tnu2)
-
-mutex_table = {}
-
-def set_mutex(tnu, mutex):
-  have = mutex_table.get(tnu, mutex)
-  if have != mutex:
-    verb = "Promoting" if have > mutex else "Demoting"
-    print("# ** %s %s, %s -> %s" % \
-          (verb, get_unique(tnu),
-           rank.mutex_to_name(have),
-           rank.mutex_to_name(mutex)))
-  mutex_table[tnu] = mutex
+  if tnu1 == forest_tnu: return forest_tnu
+  if tnu2 == forest_tnu: return forest_tnu
+  assert table.is_record(tnu1)
+  assert table.is_record(tnu2)
+  if tnu1 == tnu2: return tnu1
+  tnu1 = to_accepted(tnu1)
+  tnu2 = to_accepted(tnu2)
+  if is_ancestor(tnu1, tnu2): return tnu1
+  if is_ancestor(tnu2, tnu1): return tnu2
+  # Climb from tnu1 to the highest ancestor that isn't above tnu2
+  checklist = get_checklist(tnu1)
+  assert checklist == get_checklist(tnu2)
+  offset = checklist.uid_offset
+  for jump in reversed(checklist.jumps):
+    up = jump[tnu1 - offset]
+    if up and not is_ancestor(up, tnu2):
+      tnu1 = up
+  return checklist.parents[tnu1 - offset]    # forest_tnu if none
+
+# The given (accepted) nodes and all of their ancestors, as a set
+
+def lineages(nodes):
+  result = set()
+  for node in nodes:
+    while node != forest_tnu and not node in result:
+      result.add(node)
+      node = get_parent(node)
+  return result
 
 def get_mutex(tnu):
   if not tnu:
     # Above root of tree = forest_tnu
     return rank.forest
-  probe = mutex_table.get(tnu)
-  if probe: return probe
-  mutex = get_mutex_really(tnu)
-  assert mutex >= 0
-  mutex_table[tnu] = mutex    # Perhaps amended later
-  return mutex
-
-# Higher numbers are more tipward.
-# Parent's level > child's level for all children.
-
-def get_mutex_really(tnu):
-  tnu = to_accepted(tnu)
-
-  # Findest most rootward mutex of all the children
-  children_mutex = rank.atom     # identity for min
-  for child in get_children(tnu):
-    children_mutex = min(children_mutex, get_mutex(child))
-
-  # Treat given rank, if any, as normative
-  if get_parent(tnu) == forest_tnu:
-    mutex = rank.root
+  checklist = get_checklist(tnu)
+  return checklist.mutexes[tnu - checklist.uid_offset]
+
+def report_rank_inversion(child, parent, same):
+  if same:
+    dribble.log("# ** Child %s (%s) has same rank as parent %s" % \
+                (get_unique(child),
+                 get_nominal_rank(child),
+                 get_unique(parent)))
   else:
-    nominal = get_nominal_mutex(tnu)
-    mutex = nominal or (children_mutex - 10)
-  set_mutex(tnu, mutex)
-
-  # Demote children that have higher rank
-  correct_children_mutexes(tnu, mutex)
-
-  return mutex
-
-def correct_children_mutexes(parent, parent_mutex):
-  for child in get_children(parent):
-    child_mutex = get_mutex(child)
-    if child_mutex <= parent_mutex:
-      if child_mutex == parent_mutex:
-        dribble.log("# ** Child %s (%s) has same rank as parent %s" % \
-                    (get_unique(child),
-                     get_nominal_rank(child),
-                     get_unique(parent)))
-      else:
-        dribble.log("# ** Child %s (%s) is of higher rank than parent %s (%s)" %\
-                    (get_unique(child),
-                     get_nominal_rank(child),
-                     get_unique(parent),
-                     get_nominal_rank(parent)))
-      if is_container(child):
-        new_mutex = parent_mutex + 1 # demote!
-        set_mutex(child, new_mutex)
-        correct_children_mutexes(child, new_mutex) # ?
-      else:
-        set_mutex(child, parent_mutex + 10)  # demote!
+    dribble.log("# ** Child %s (%s) is of higher rank than parent %s (%s)" %\
+                (get_unique(child),
+                 get_nominal_rank(child),
+                 get_unique(parent),
+                 get_nominal_rank(parent)))
+
+def report_mutex_change(tnu, have, mutex):
+  verb = "Promoting" if have > mutex else "Demoting"
+  print("# ** %s %s, %s -> %s" % \
+        (verb, get_unique(tnu),
+         rank.mutex_to_name(have),
+         rank.mutex_to_name(mutex)))
 
 def get_nominal_mutex(tnu):
   nominal = get_nominal_rank(tnu) # name of rank
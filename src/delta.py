@@ -0,0 +1,118 @@
+#!/bin/env python3
+
+# Record-level changes between two versions of the same source
+# (e.g. two NCBI releases converted to CSV), matched up by taxonID.
+
+#   python3 src/delta.py old.csv new.csv --out changes.csv
+
+# Each record is reduced to a hash of its property values (only the
+# columns that table.py recognizes, or those in the projection), so
+# neither file is held in memory: one streaming pass over the new file
+# collects the hashes (and parents), and one over the old file
+# classifies each record as unchanged, modified, added or removed.  The old versions of
+# modified and removed records are kept, since what they used to say
+# (e.g. their parents) is gone from the new file.
+
+import csv, hashlib, argparse
+
+import checklist as cl
+import property
+import archive
+import dribble
+
+unchanged = "unchanged"
+modified = "modified"
+added = "added"
+removed = "removed"
+
+class Delta:
+  def __init__(self):
+    self.statuses = {}          # taxonID -> status, if not unchanged
+    self.old_records = {}       # taxonID -> record, if modified or removed
+    self.parents = set()        # taxonIDs, see below
+
+  def status(self, id):
+    return self.statuses.get(id, unchanged)
+
+  # True if the record is unchanged and so is the number of its
+  # children.  parents has the old and new parents of every changed
+  # record.
+
+  def same(self, id):
+    return not id in self.statuses and not id in self.parents
+
+def compare(old_path, new_path, projection = None):
+  delta = Delta()
+  new = {}                      # taxonID -> (hash, parent)
+  hashes = read_hashes(new_path, projection)
+  next(hashes)
+  for (id, parent, digest, row) in hashes:
+    new[id] = (digest, parent)
+  hashes = read_hashes(old_path, projection)
+  header = next(hashes)
+  for (id, parent, digest, row) in hashes:
+    probe = new.pop(id, None)
+    if probe == None:
+      delta.statuses[id] = removed
+    elif probe[0] != digest:
+      delta.statuses[id] = modified
+      if probe[1]: delta.parents.add(probe[1])
+    else:
+      continue
+    delta.old_records[id] = dict(zip(header, row))
+    if parent: delta.parents.add(parent)
+  for (id, (digest, parent)) in new.items():
+    delta.statuses[id] = added
+    if parent: delta.parents.add(parent)
+  counts = {status: 0 for status in (modified, added, removed)}
+  for status in delta.statuses.values():
+    counts[status] += 1
+  dribble.log("# %s to %s: %s modified, %s added, %s removed" %
+              (old_path, new_path,
+               counts[modified], counts[added], counts[removed]))
+  return delta
+
+# Yields the header, then (taxonID, parent taxonID, hash, row) for each
+# record in the file.  The hash covers the non-empty values of the
+# recognized columns, so the order of the columns doesn't matter.
+
+def read_hashes(path, projection = None):
+  (delim, qc, qu) = archive.csv_parameters(path)
+  with archive.open_text(path) as infile:
+    reader = csv.reader(infile, delimiter=delim, quotechar=qc, quoting=qu)
+    header = next(reader)
+    yield header
+    # As in table.Table, if a property occurs twice the last column wins
+    positions = {}
+    for (position, label) in enumerate(header):
+      prop = property.properties_by_pet_name.get(label)
+      if prop and (projection == None or prop in projection):
+        positions[prop] = position
+    hashed = sorted(positions.items(), key=lambda item: item[0].uid)
+    id_position = positions[cl.taxon_id]
+    parent_position = positions.get(cl.parent_taxon_id)
+    for row in reader:
+      if not row: continue
+      h = hashlib.blake2b(digest_size=16)
+      for (prop, position) in hashed:
+        value = row[position]
+        if value != '':
+          h.update(("%s\x1e%s\x1f" % (prop.pet_name, value)).encode("utf-8"))
+      parent = row[parent_position] if parent_position != None else ''
+      yield (row[id_position], parent or None, h.digest(), row)
+
+def write_changes(delta, outpath):
+  with open(outpath, "w", newline="") as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(["taxonID", "status"])
+    for (id, status) in delta.statuses.items():
+      writer.writerow([id, status])
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('old', help='earlier version of the checklist')
+  parser.add_argument('new', help='later version of the checklist')
+  parser.add_argument('--out', help='where to write the changed taxonIDs',
+                      default='changes.csv')
+  args = parser.parse_args()
+  write_changes(compare(args.old, args.new), args.out)
@@ -1,11 +1,14 @@
 
 import sys
 import checklist as cl
+import session
 
-dribble_file = None
+# Messages go to standard output and to the current session's
+# dribble_file, if it has one
 
 def log(message):
   print(message)
+  dribble_file = session.current().dribble_file
   if dribble_file:
     print(message, file=dribble_file)
 
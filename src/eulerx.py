@@ -32,6 +32,7 @@ import argparse
 import checklist as cl
 import relation as rel
 import alignment
+from traversal import walk
 
 def load(s, prefix = ""):
   ch = cl.Checklist(prefix)
@@ -48,11 +49,8 @@ def dump(ch, outpath):
           for child in children:
             out.write(" %s" % cl.get_spaceless(child))
           out.write(")\n")
-        for child in children:
-          process(child)
     out.write("taxonomy %s %s\n" % (ch.prefix, ch.name.replace(" ", "_")))
-    for root in cl.get_roots(ch):
-      process(root)
+    walk(cl.get_roots(ch), cl.get_children, pre = process)
     out.write("\n")
 
 def dump_alignment(al, out):
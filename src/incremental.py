@@ -0,0 +1,375 @@
+# Incremental re-alignment.
+
+# From one release of a big checklist to the next, few records change.
+# So the state of an alignment - for each accepted node, its mutex,
+# best match, cross-mrca, intensional proposal and final articulation -
+# can be saved to a file (keyed by taxonID, see save), and the
+# alignment of the new releases computed from that and from the
+# record-level changes between the old and new inputs (see delta.py).
+# What a changed record can affect is recomputed:
+
+#   best matches - for touched nodes (see touched_nodes), for the
+#     nodes sharing a match value with a touched node or a changed
+#     record, and for nodes that are or were in identical subtrees
+#     or paired as unchanged records (see alignment.presumed_matches);
+#   cross-mrcas - for nodes whose best match or mutual match changed,
+#     nodes whose old partner is an ancestor of a touched node, and
+#     their ancestors while the result keeps changing;
+#   propose_alignment - for the chains (a pair of nodes that are each
+#     other's cross-mrcas, and the nodes whose cross-mrcas are one of
+#     the two) that have a node whose inputs changed.
+
+# Everything else is carried over from the saved state, and the result
+# is the same as that of alignment.align.  intension.intensional_proposal
+# is redone in full; it's a quick pass over the best matches.  Some
+# bookkeeping (reading the saved state, walking the trees in order)
+# still takes time in proportion to the size of the checklists.
+
+import csv, json
+
+import checklist as cl
+import delta
+import relation as rel
+import articulation as art
+import alignment
+import intension
+import property
+import dribble
+from traversal import walk
+
+# The record-level changes between old and new inputs come from
+# delta.compare.  The old records (dicts from column label to value) of
+# modified and removed records tell what the records used to say.
+
+def record_value(record, prop):
+  value = None
+  for (label, v) in record.items():
+    if property.properties_by_pet_name.get(label) == prop and v != '':
+      value = v
+  return value
+
+# ---------- Saved state
+
+# One row per accepted node of either checklist.  checklist is A or B
+# as in alignment.align(B, A); partner is the node's cross-mrca; the
+# articulation columns are as written by encode.
+
+columns = ["checklist", "taxonID", "mutex", "partner",
+           "best", "xmrca", "proposal", "alignment"]
+
+def save(A, B, best, xmrcas, proposal, al, outpath):
+  refs = Refs(A, B)
+  with open(outpath, "w", newline="") as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(columns)
+    for (side, checklist) in (("A", A), ("B", B)):
+      for node in checklist.get_all_nodes():
+        if cl.is_accepted(node):
+          partner = xmrcas.get(node)
+          writer.writerow([side, cl.get_taxon_id(node), cl.get_mutex(node),
+                           refs.ref(partner.cod) if partner else "",
+                           refs.encode(best.get(node)),
+                           refs.encode(partner),
+                           refs.encode(proposal.get(node)),
+                           refs.encode(al.get(node))])
+  dribble.log("# Saved alignment state to %s" % outpath)
+
+# Returns {node reference: [mutex, partner, best, xmrca, proposal,
+# alignment]}, with the values as they are in the file
+
+def load(inpath):
+  saved = {}
+  with open(inpath, "r", newline="") as infile:
+    reader = csv.reader(infile)
+    header = next(reader)
+    assert header == columns
+    for row in reader:
+      saved["%s:%s" % (row[0], row[1])] = row[2:]
+  dribble.log("# Loaded alignment state for %s nodes from %s" %
+              (len(saved), inpath))
+  return saved
+
+# Nodes are referred to as A:taxonID or B:taxonID.  An articulation is
+# written as a JSON list [relation, dom, cod, reason, revreason,
+# factors], where factors is a list of articulations, or null.
+
+class Refs:
+  def __init__(self, A, B):
+    self.sides = {A: "A", B: "B"}
+    self.checklists = {"A": A, "B": B}
+    self.refs = {}
+    self.nodes = {}
+
+  def ref(self, node):
+    r = self.refs.get(node)
+    if r == None:
+      r = "%s:%s" % (self.sides[cl.get_checklist(node)], cl.get_taxon_id(node))
+      self.refs[node] = r
+    return r
+
+  # Raises LookupError if there is no such node (any more)
+
+  def node(self, r):
+    node = self.nodes.get(r)
+    if node == None:
+      (side, id) = r.split(":", 1)
+      node = cl.get_record_with_taxon_id(self.checklists[side], id)
+      if node == None:
+        raise LookupError("no node %s" % r)
+      self.nodes[r] = node
+    return node
+
+  def encode(self, ar):
+    if ar == None: return ""
+    return json.dumps(self.pack(ar))
+
+  def pack(self, ar):
+    return [ar.relation.name, self.ref(ar.dom), self.ref(ar.cod),
+            ar.reason, ar.revreason,
+            [self.pack(factor) for factor in ar.factors] if ar.factors else None]
+
+  def decode(self, text):
+    if text == "": return None
+    return self.unpack(json.loads(text))
+
+  def unpack(self, packed):
+    (name, dom, cod, reason, revreason, factors) = packed
+    return art.Articulation(self.node(dom), self.node(cod),
+                            rel.relations_by_name[name],
+                            [self.unpack(factor) for factor in factors]
+                              if factors else None,
+                            reason, revreason)
+
+# ---------- Alignment
+
+# Like alignment.align, but if previous (a file written by save) is
+# given, only what the changes (B_delta and A_delta, from delta.compare;
+# None if there are none) can affect is recomputed.  If save_path is
+# given, the new state is saved there.  source_delta is as for
+# alignment.align.
+
+def align(B, A, previous = None, B_delta = None, A_delta = None,
+          save_path = None, processes = 1, source_delta = None):
+  if previous == None:
+    state = {}
+    (al, xmrcas) = alignment.align(B, A, processes = processes,
+                                   state = state,
+                                   source_delta = source_delta)
+    (best, proposal) = (state["best"], state["proposal"])
+  else:
+    (best, xmrcas, proposal, al) = \
+      realign(B, A, load(previous), B_delta, A_delta, processes,
+              source_delta)
+  if save_path:
+    save(A, B, best, xmrcas, proposal, al, save_path)
+  return (al, xmrcas)
+
+def realign(B, A, saved, B_delta, A_delta, processes = 1,
+            source_delta = None):
+  refs = Refs(A, B)
+  deltas = {A: A_delta or delta.Delta(), B: B_delta or delta.Delta()}
+  accepteds = {X: [node for node in X.get_all_nodes() if cl.is_accepted(node)]
+               for X in (A, B)}
+  touched = {X: touched_nodes(X, accepteds[X], deltas[X], saved, refs)
+             for X in (A, B)}
+  dribble.log("# Touched nodes: %s %s" % (len(touched[A]), len(touched[B])))
+
+  # Best matches.  Identical subtrees and unchanged records are found
+  # afresh (it's quick), and a node that used to be paired that way
+  # but no longer is gets recomputed.
+  same = alignment.presumed_matches(A, B, source_delta)
+  dirty = set()
+  for (X, Y) in ((A, B), (B, A)):
+    dirty |= touched[X]
+    dirty |= linked_nodes(touched[X], deltas[X], Y)
+  carried = {}
+  for X in (A, B):
+    for node in accepteds[X]:
+      if not node in dirty and not node in same:
+        row = saved.get(refs.ref(node))
+        try:
+          if row != None:
+            ar = refs.decode(row[2])
+            if not (ar and ar.reason in ("subtree", "unchanged")):
+              carried[node] = ar
+        except LookupError:
+          pass
+  known = dict(carried)
+  known.update(same)
+  best = intension.best_intensional_match_map(B, A, processes, known)
+  recomputed = [node
+                for X in (A, B)
+                for node in accepteds[X]
+                if not node in carried]
+  best_changed = set(node for node in recomputed
+                     if (refs.encode(best.get(node)) !=
+                         saved_cell(saved, refs, node, 2)))
+  dribble.log("# Recomputed %s best matches, %s changed" %
+              (len(recomputed), len(best_changed)))
+
+  # Cross-mrcas, in the same order as alignment.infer_partners
+  xmrcas = {}
+  xmrca_changed = set()
+  def half_realign_partners(X, other_ancestors):
+    def subrealign_partners(x, results):
+      recompute = (any(changed for (ar, changed) in results) or
+                   x in touched[X] or x in best_changed)
+      bar = best.get(x)
+      if bar and bar.cod in best_changed:
+        recompute = True
+      row = saved.get(refs.ref(x))
+      if row == None:
+        recompute = True
+      if not recompute:
+        try:
+          # Often the same as the best match
+          ar = bar if row[3] == row[2] else refs.decode(row[3])
+          if ar and ar.cod in other_ancestors:
+            recompute = True
+        except LookupError:
+          recompute = True
+      changed = False
+      if recompute:
+        ar = alignment.cross_mrca(x, [ar for (ar, changed) in results], best)
+        changed = refs.encode(ar) != (row[3] if row else "")
+        if changed: xmrca_changed.add(x)
+      if ar: xmrcas[x] = ar
+      return (ar, changed)
+    walk(cl.get_roots(X), cl.get_children, post = subrealign_partners)
+  half_realign_partners(A, ancestors(touched[B]))
+  half_realign_partners(B, ancestors(touched[A]))
+  dribble.log("# Number of cross-mrcas: %s, %s changed" %
+              (len(xmrcas), len(xmrca_changed)))
+
+  # Proposal
+  proposal = intension.intensional_proposal(best, A, B)
+  al = realign_proposal(dict(proposal), best, xmrcas, saved, refs,
+                        accepteds[A] + accepteds[B],
+                        touched[A] | touched[B] | best_changed | xmrca_changed,
+                        xmrca_changed)
+  return (best, xmrcas, proposal, al)
+
+# Chains are found by partner references: new ones from xmrcas, old
+# ones from the saved state.  A chain that contains a changed node,
+# in either its old or its new form, is redone.
+
+def realign_proposal(proposal, best, xmrcas, saved, refs, accepteds,
+                     changed, xmrca_changed):
+  new_partners = {refs.ref(x): refs.ref(ar.cod) for (x, ar) in xmrcas.items()}
+  old_partners = {r: row[1] for (r, row) in saved.items() if row[1]}
+  dirty = set(refs.ref(node) for node in changed)
+  for node in accepteds:
+    if refs.encode(proposal.get(node)) != saved_cell(saved, refs, node, 4):
+      dirty.add(refs.ref(node))
+  # Nodes that lost their partners (e.g. were removed)
+  dirty |= set(r for r in old_partners if not r in new_partners)
+  # A node's articulation also depends on its partner's partner and
+  # that one's partner
+  xmrca_changed = set(refs.ref(node) for node in xmrca_changed)
+  for (r, partner) in new_partners.items():
+    if partner in xmrca_changed or new_partners.get(partner) in xmrca_changed:
+      dirty.add(r)
+  dirty_chains = set()
+  for r in dirty:
+    for partners in (new_partners, old_partners):
+      chain = chain_key(r, partners)
+      if chain != None: dirty_chains.add(chain)
+  # The articulations of the other chains are as they were
+  carried = {}
+  for x in xmrcas:
+    chain = chain_key(refs.ref(x), new_partners)
+    if not chain in dirty_chains:
+      row = saved.get(refs.ref(x))
+      try:
+        if row[5] == row[4]:
+          ar = proposal.get(x)
+        elif row[5] == row[2]:
+          ar = best.get(x)
+        else:
+          ar = refs.decode(row[5])
+        carried[x] = (chain, ar)
+      except LookupError:
+        dirty_chains.add(chain)
+  count = 0
+  for x in xmrcas:
+    if chain_key(refs.ref(x), new_partners) in dirty_chains:
+      count += 1
+      if not proposal.get(x):
+        alignment.alignment_step(x, best, xmrcas, proposal)
+  for (x, (chain, ar)) in carried.items():
+    if ar and not chain in dirty_chains:
+      proposal[x] = ar
+  dribble.log("# Redid %s of %s chain nodes" % (count, len(xmrcas)))
+  return proposal
+
+# A pair of nodes that are each other's partners, and the nodes whose
+# partner is one of the two, are a chain (see alignment.alignment_step);
+# any other node with a partner is alone.
+
+def chain_key(r, partners):
+  y = partners.get(r)
+  if y == None: return None
+  x = partners.get(y)
+  if x != None and partners.get(x) == y:
+    return (min(x, y), max(x, y))
+  return r
+
+def saved_cell(saved, refs, node, i):
+  row = saved.get(refs.ref(node))
+  return row[i] if row else ""
+
+# Touched nodes of a checklist: those whose records changed, the old and
+# new parents and accepted nodes of changed records, and the nodes
+# whose mutex changed.  Synonyms are replaced by their accepted nodes.
+
+def touched_nodes(checklist, accepteds, record_changes, saved, refs):
+  nodes = set()
+  def touch(node):
+    if node != None: nodes.add(cl.to_accepted(node))
+  def touch_id(id):
+    touch(cl.get_record_with_taxon_id(checklist, id))
+  for id in record_changes.statuses:
+    node = cl.get_record_with_taxon_id(checklist, id)
+    if node != None:
+      touch(node)
+      touch(cl.get_raw_parent(node))
+  for id in record_changes.parents:
+    touch_id(id)
+  for record in record_changes.old_records.values():
+    for prop in (cl.parent_taxon_id, cl.accepted_taxon_id):
+      value = record_value(record, prop)
+      if value != None: touch_id(value)
+  for node in accepteds:
+    row = saved.get(refs.ref(node))
+    if row == None or int(row[0]) != cl.get_mutex(node):
+      nodes.add(node)
+  return nodes
+
+# Accepted nodes of other whose best matches could depend on the
+# touched nodes or changed records: those having (or having a synonym
+# with) one of their match values
+
+def linked_nodes(touched, record_changes, other):
+  values = set()
+  for record in record_changes.old_records.values():
+    for prop in cl.match_properties:
+      value = record_value(record, prop)
+      if value != None: values.add((prop, value))
+  for node in touched:
+    for n in [node] + cl.get_synonyms(node):
+      for prop in cl.match_properties:
+        value = cl.get_value(n, prop)
+        if value != None: values.add((prop, value))
+  return set(cl.to_accepted(node)
+             for (prop, value) in values
+             for node in cl.get_nodes_with_value(other, prop, value))
+
+# The nodes and all their ancestors
+
+def ancestors(nodes):
+  result = set()
+  for node in nodes:
+    while node != cl.forest_tnu and not node in result:
+      result.add(node)
+      node = cl.get_parent(node)
+  return result
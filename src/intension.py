@@ -1,7 +1,11 @@
+import io
+import multiprocessing
 import checklist as cl
 import articulation as art
 import relation as rel
 import dribble
+import session
+from traversal import walk
 
 # Temporary hack for experimenting with poorly formed EOL checklists
 EOL = False
@@ -10,23 +14,73 @@ EOL = False
 
 # The source node ('node') may be accepted or a synonym.
 
-def best_intensional_match_map(A, B):
-  best = {}
+# With processes > 1, the nodes are divided among that many forked
+# worker processes, which see the loaded checklists as they were at the
+# time of the fork.  Their results are proclaimed in the same order as
+# they would be without workers, so the outcome is the same.
+# carried maps nodes to best matches (or None) already known, e.g.
+# between identical subtrees (see alignment.subtree_matches) or from an
+# earlier alignment (see incremental.py); those aren't recomputed.
+# Only a node that shares a match property value with the other
+# checklist, itself or through a synonym, can have a match, so only
+# those nodes are looked at (in uid order, as get_all_nodes has them).
+
+def best_intensional_match_map(A, B, processes = 1, carried = None):
+  carried = carried or {}
+  best = {node: ar for (node, ar) in carried.items() if ar}
   def process(here, there):
-    for node in here.get_all_nodes():
-      if cl.is_accepted(node) and not node in best:
-        ar = best_intensional_match(node, there)
-        if dribble.watch(node):
-          dribble.log("# Best: %s" % art.express(ar))
-        if ar:
-          assert ar.dom == node
-          assert cl.is_accepted(ar.cod)
-          art.half_proclaim(best, ar)
+    candidates = set(cl.to_accepted(node) for node in art.join(here, there))
+    nodes = [node for node in sorted(candidates)
+             if (cl.is_accepted(node) and not node in best and
+                 not node in carried)]
+    for (node, ar) in zip(nodes, best_matches(nodes, there, processes)):
+      if dribble.watch(node):
+        dribble.log("# Best: %s" % art.express(ar))
+      if ar:
+        assert ar.dom == node
+        assert cl.is_accepted(ar.cod)
+        art.half_proclaim(best, ar)
   process(A, B)
   process(B, A)
   dribble.log("%s best matches" % len(best))
   return best
 
+# Best match in other for each of nodes (None if none), in order
+
+def best_matches(nodes, other, processes = 1):
+  if (processes <= 1 or len(nodes) < 2 * processes or
+      not "fork" in multiprocessing.get_all_start_methods()):
+    for node in nodes:
+      yield best_intensional_match(node, other)
+    return
+  # Do the join in advance, so that the workers share it
+  art.join(cl.get_checklist(nodes[0]), other)
+  dribble_file = session.current().dribble_file
+  if dribble_file: dribble_file.flush()
+  size = (len(nodes) + 4 * processes - 1) // (4 * processes)
+  shards = [nodes[i : i + size] for i in range(0, len(nodes), size)]
+  global shard_other
+  shard_other = other
+  with multiprocessing.get_context("fork").Pool(processes) as pool:
+    results = pool.map(best_matches_in_shard, shards)
+  shard_other = None
+  for shard_results in results:
+    for (packed, log) in shard_results:
+      # The worker printed its commentary; it still belongs in the log
+      if dribble_file and log: dribble_file.write(log)
+      yield art.unpack(packed)
+
+shard_other = None
+
+def best_matches_in_shard(nodes):
+  results = []
+  for node in nodes:
+    log = io.StringIO()
+    session.current().dribble_file = log
+    ar = best_intensional_match(node, shard_other)
+    results.append((art.pack(ar), log.getvalue()))
+  return results
+
 # Three components: synonym-or-self o direct o synonym-of-or-self
 # from_accepted_articulations o direct_matches o [to_accepted_articulation]
 
@@ -227,12 +281,12 @@ def is_matches(matches):
 # Filter out internal nodes (those having a matched descendant)
 
 def tipward(amap, A, B):
+  matched = cl.lineages(amap)
   tw = {}
-  def filter(node):
+  def filter(node, results):
     watch = dribble.watch(node)
     found_match = None
-    for child in cl.get_children(node):
-      ar = filter(child)
+    for ar in results:
       if ar:
         found_match = ar
     if found_match:    # Some descendant is a particle
@@ -249,7 +303,9 @@ def tipward(amap, A, B):
       else:
         if watch: dribble.log("# %s is unmatched" % cl.get_unique(node))
       return ar
-  for root in cl.get_roots(A): filter(root)
-  for root in cl.get_roots(B): filter(root)
+  # Subtrees without matches have nothing to keep
+  pre = lambda node: node in matched
+  walk(cl.get_roots(A), cl.get_children, pre = pre, post = filter)
+  walk(cl.get_roots(B), cl.get_children, pre = pre, post = filter)
   return tw
 
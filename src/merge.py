@@ -14,10 +14,13 @@
 import checklist as cl
 import relation as rel
 import dribble
+from traversal import walk
 
 # 'al' is a proposal (alignment)
 
-def merge_checklists(A, B, al):
+def merge_checklists(A, B, al, session = None):
+  if session:
+    with session: return merge_checklists(A, B, al)
   parents = {}
   roots = []
   def half_compute_parents(check, inject, al, retractions):
@@ -39,10 +42,7 @@ def merge_checklists(A, B, al):
             dribble.log("# No merge(%s)" % cl.get_unique(node))
           if not merged in roots:
             roots.append(merged)
-      for child in cl.get_children(node):
-        process(child)
-    for root in cl.get_roots(check):
-      process(root)
+    walk(cl.get_roots(check), cl.get_children, pre = process)
   half_compute_parents(B, inject_B, al, {})
   # Retractions.
   retractions = find_incompatibilities(A, B, al)
@@ -55,9 +55,8 @@ def merged_parent(merged, al, retract):
 
   # Like get_parent except skip retracted nodes
   def compatible_ancestor(x):
-    p = cl.get_parent(x)
-    if p in retract:
-      return compatible_ancestor(p)
+    while cl.get_parent(x) in retract:
+      x = cl.get_parent(x)
     return x
 
   (x, y) = merged    # False if node is inconsistent
@@ -129,10 +128,7 @@ def find_incompatibilities(A, B, proposal):
       proof = test_compatibility(ar.dom, ar.cod, proposal)
       if proof:
         retractions[x] = proof
-    for child in cl.get_children(x):
-      process(child)
-  for root in cl.get_roots(A):
-    process(root)
+  walk(cl.get_roots(A), cl.get_children, pre = process)
   return retractions
 
 # (yk, c, d, e) = test_compatibility(x, y, xmrcas)
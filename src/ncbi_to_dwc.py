@@ -1,5 +1,6 @@
 """
  Converts an NCBI dump to a DwCA TNU (taxon) file.
+ The dump can be a directory or the zip file as downloaded.
  Fold the scientific name (-> canonicalName) and authority (if it
  extends the scientific name) into the taxon record.
 
@@ -12,14 +13,22 @@
 """
 
 import sys, os, csv, argparse
+import archive
+
+# The output is written as the inputs are read.  The only things held
+# in memory are the canonical name and authority of each taxon, which
+# come from a first pass over names.dmp; nodes.dmp, the rest of
+# names.dmp, and merged.dmp are then streamed through to the output.
 
 def main(indir, outpath):
   assert os.path.exists(indir)
-  accepteds = read_accepteds(os.path.join(indir, "nodes.dmp"))
-  names = read_names(os.path.join(indir, "names.dmp"))
-  merged = read_merged(os.path.join(indir, "merged.dmp"))
-  (synonyms, scinames, authorities) = collate_names(names, accepteds)
-  emit_dwc(accepteds, synonyms, scinames, authorities, merged, outpath)
+  names_path = os.path.join(indir, "names.dmp")
+  (scinames, authorities) = collate_names(names_path)
+  emit_dwc(read_accepteds(os.path.join(indir, "nodes.dmp")),
+           read_synonyms(names_path, scinames),
+           scinames, authorities,
+           read_merged(os.path.join(indir, "merged.dmp")),
+           outpath)
 
 def write_row(writer,
               taxonID, ncbi_id, parentNameUsageID, taxonRank,
@@ -29,9 +38,11 @@ def write_row(writer,
                    acceptedNameUsageID, scientificName, canonicalName,
                    taxonomicStatus, nomenclaturalStatus])
 
+# accepteds, synonyms and merged are iterables (read_accepteds etc.)
+
 def emit_dwc(accepteds, synonyms, scinames, authorities, merged, outpath):
-  outdir = os.path.basename(outpath)
-  if not os.path.isdir(outdir): os.mkdir(outdir)
+  outdir = os.path.dirname(outpath)
+  if outdir and not os.path.isdir(outdir): os.mkdir(outdir)
   (delimiter, quotechar, mode) = csv_parameters(outpath)
   print ("Writing", outpath)
   with open(outpath, "w") as outfile:
@@ -73,44 +84,56 @@ def emit_dwc(accepteds, synonyms, scinames, authorities, merged, outpath):
                 new_id, None, canonical,
                 "synonym", "merged id")
 
-# Input: list of (id, text, kind, spin) from names.txt file
-# Output: list of (id, text, kind, spin); 
-#         dict: id -> text [canonical names];
+# Input: path to names.dmp
+# Output: dict: id -> text [canonical names];
 #         dict: id -> text [authorities]
+# An authority is taken to be the scientific name if it extends the
+# canonical name.  Everything else is a synonym (see read_synonyms).
 
-def collate_names(names, accepteds):
-  keep = []
+def collate_names(names_path):
   scinames = {}
-  for row in names:
-    (id, text, kind, spin) = row
-    if kind == "scientific name":
-      scinames[id] = text
-    else:
-      keep.append(row)
-  # Remove the canonical names, keep the rest
-  names2 = keep
-  keep = None #GC
-  print (len(scinames), "canonicalNames (NCBI scientific names)")
-  synonyms = []
   authorities = {}
-  for row in names2:
-    (id, text, kind, spin) = row
-    if kind == "authority":
-      probe = scinames.get(id, None)
-      if probe and text.startswith(probe):
+  # Rows for one taxon are together, but the scientific name needn't
+  # come before the authority
+  def collate(group):
+    for (id, text, kind, spin) in group:
+      if kind == "scientific name":
+        scinames[id] = text
+    for (id, text, kind, spin) in group:
+      if is_authority(id, text, kind, scinames):
         authorities[id] = text
-      else:
-        synonyms.append(row)
-    else:
-      synonyms.append(row)
-  # Remove authorities (= scientific names), keep the rest
+  group = []
+  for row in read_names(names_path):
+    if group and row[0] != group[0][0]:
+      collate(group)
+      group = []
+    group.append(row)
+  collate(group)
+  print (len(scinames), "canonicalNames (NCBI scientific names)")
   print (len(authorities), "scientificNames (NCBI authorities)")
-  return (synonyms, scinames, authorities)
+  return (scinames, authorities)
+
+def is_authority(id, text, kind, scinames):
+  if kind == "authority":
+    probe = scinames.get(id, None)
+    return probe and text.startswith(probe)
+  return False
+
+# Generates (id, text, kind, spin) for the names that are neither
+# scientific names nor authorities
+
+def read_synonyms(names_path, scinames):
+  for row in read_names(names_path):
+    (id, text, kind, spin) = row
+    if kind != "scientific name" and not is_authority(id, text, kind, scinames):
+      yield row
+
+# Generates (id, parent_id, rank)
 
 def read_accepteds(nodes_path):
-  accepteds = []
+  count = 0
   # Read the nodes file
-  with open(nodes_path, "r") as infile:
+  with archive.open_text(nodes_path) as infile:
     for row in csv.reader(infile,
                           delimiter="\t",
                           quotechar="\a",
@@ -119,14 +142,16 @@ def read_accepteds(nodes_path):
       rank = row[4]
       if rank == "clade" or rank == "no rank":
         rank = None
-      accepteds.append((row[0], row[2], rank))
-  print (len(accepteds), "accepteds")
-  return accepteds
+      count += 1
+      yield (row[0], row[2], rank)
+  print (count, "accepteds")
+
+# Generates (id, text, kind, spin)
 
 def read_names(names_path):
-  names = []
+  count = 0
   # Read the names file
-  with open(names_path, "r") as infile:
+  with archive.open_text(names_path) as infile:
     # Depends on names being grouped by taxa
     previous_id = None
     spin = -1
@@ -141,22 +166,24 @@ def read_names(names_path):
         previous_id = id
       else:
         spin += 1
-      names.append((id, row[2], row[6], spin))
-  print (len(names), "names")
-  return names
+      count += 1
+      yield (id, row[2], row[6], spin)
+  print (count, "names")
+
+# Generates (old_id, new_id)
 
 def read_merged(merged_path):
-  merged = []
+  count = 0
   # Read the merged file
-  with open(merged_path, "r") as infile:
+  with archive.open_text(merged_path) as infile:
     for row in csv.reader(infile,
                           delimiter="\t",
                           quotechar="\a",
                           quoting=csv.QUOTE_NONE):
       # old_tax_id, |, new_tax_id
-      merged.append((row[0], row[2]))
-  print (len(merged), "merged")
-  return merged
+      count += 1
+      yield (row[0], row[2])
+  print (count, "merged")
 
 def csv_parameters(path):
   if path.endswith(".csv"):
@@ -170,7 +197,7 @@ def csv_parameters(path):
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
-  parser.add_argument('dump', help='directory containing taxdump files')
+  parser.add_argument('dump', help='directory or zip file containing taxdump files')
   parser.add_argument('--out', help='where to store the DwC version')
   args = parser.parse_args()
   main(args.dump, args.out)
@@ -10,32 +10,91 @@ import relation as rel
 import articulation as art
 import eulerx
 import alignment
+import incremental
+import delta
 import changes
 import merge
 import dribble
+import snapshot
 import diff
+from session import Session
+from traversal import walk
 
 # A is lower priority, B is higher
 
-def main(c1, c1_tag, c2, c2_tag, out, format):
-  global dribble_file
+# If project is true, only the columns that alignment uses are read.
+# (The report formats consult no others, except that the changed_props
+# column of the default report then covers only those columns.)
+
+# With processes > 1, the two checklists are read concurrently, and
+# matching is spread over that many processes.
+
+# If c1_root or c2_root (a taxonID) is given, only that subtree of the
+# checklist is compared.
+
+# If same_source is true, the two checklists are taken to be versions
+# of the same source, and records that are unchanged by taxonID, as
+# found by delta.compare before aligning, are matched to themselves
+# without searching (see alignment.presumed_matches).  Those whose
+# numbers of children are unchanged too are reported as unchanged
+# without comparing them.
+
+# If save_state is given, the state of the alignment is saved there.
+# If previous is given, it's a state saved by an earlier run, whose
+# inputs were previous_c1 and previous_c2 (or c1 and c2 themselves, if
+# those aren't given); the alignment is then done incrementally (see
+# incremental.py).
+
+def main(c1, c1_tag, c2, c2_tag, out, format, cache = False, mapped = False,
+         project = False, processes = 1, c1_root = None, c2_root = None,
+         save_state = None, previous = None,
+         previous_c1 = None, previous_c2 = None, same_source = False):
+  projection = set(cl.alignment_properties) if project else None
   dribpath = out + ".log"
-  with open(dribpath, "w") as dribfile:
-    dribble.dribble_file = dribfile
+  with open(dribpath, "w") as dribfile, Session() as session:
+    session.dribble_file = dribfile
     dribble.log ("\nLogging to %s" % (dribpath,))
-    A = cl.read_checklist(c1, c1_tag + ".", "low-checklist")
-    B = cl.read_checklist(c2, c2_tag + ".", "high-checklist")
+    if processes > 1 and not c1.endswith(')') and not c2.endswith(')'):
+      (A, B) = snapshot.read_checklists_in_parallel(
+                 [(c1, c1_tag + ".", "low-checklist"),
+                  (c2, c2_tag + ".", "high-checklist")],
+                 cache, mapped, projection)
+    else:
+      # A's match indexes are built while B is being read
+      A = cl.read_checklist(c1, c1_tag + ".", "low-checklist",
+                            cache, mapped, projection, background = True)
+      B = cl.read_checklist(c2, c2_tag + ".", "high-checklist",
+                            cache, mapped, projection)
+    if c1_root: A = cl.scope(A, c1_root)
+    if c2_root: B = cl.scope(B, c2_root)
     dribble.log ("Node counts: %s %s" % (len(A.get_all_nodes()), len(B.get_all_nodes())))
     # Map each B to a corresponding A
+    source_delta = delta.compare(c1, c2, projection) if same_source else None
     dribble.log ("Aligning ...")
-    (al, xmrcas) = alignment.align(B, A)
+    if previous or save_state:
+      A_delta = None
+      B_delta = None
+      if previous and previous_c1:
+        A_delta = delta.compare(previous_c1, c1, projection)
+      if previous and previous_c2:
+        B_delta = delta.compare(previous_c2, c2, projection)
+      (al, xmrcas) = incremental.align(B, A, previous, B_delta, A_delta,
+                                       save_state, processes, source_delta)
+    else:
+      (al, xmrcas) = alignment.align(B, A, processes = processes,
+                                     source_delta = source_delta)
     dribble.log("  ... finished aligning; %s articulations\n" %
                 len(al))
     # Where do xmrcas come from?
-    write_report(A, B, al, xmrcas, format, out)
-    dribble.dribble_file = None
+    write_report(A, B, al, xmrcas, format, out, source_delta = source_delta)
 
-def write_report(A, B, al, xmrcas, format, outpath):
+# source_delta, if given, is the delta.compare of A's and B's inputs
+
+def write_report(A, B, al, xmrcas, format, outpath, session = None,
+                 source_delta = None):
+  if session:
+    with session: return write_report(A, B, al, xmrcas, format, outpath,
+                                      source_delta = source_delta)
   if format == "eulerx":
     eulerx.dump_alignment(al, outpath)
   elif format == "diff":
@@ -49,17 +108,14 @@ def write_report(A, B, al, xmrcas, format, outpath):
       (parents, roots) = merge.merge_checklists(A, B, al)
       dribble.log ("Merged.  %s roots in merge, %s nodes with parents" %
                    (len(roots), len(parents)))
-      report(A, B, al, roots, parents, outfile)
+      report(A, B, al, roots, parents, outfile, source_delta = source_delta)
     report_on_collisions(A, B, al)
 
 def assign_ids(parents, roots, children):
   id_table = {}
   def process(node):
     id_table[node] = len(id_table) + 1
-    for child in children.get(node, []):
-      process(child)
-  for root in roots:
-    process(root)
+  walk(roots, lambda node: children.get(node, []), pre = process)
   return id_table
 
 canonical_name = cl.field("canonicalName")
@@ -89,12 +145,17 @@ def report_on_collisions(A, B, al):
 
 # Default (simplified) report format
 
-def report(A, B, al, roots, parents, outfile):
+def report(A, B, al, roots, parents, outfile, session = None,
+           source_delta = None):
+  if session:
+    with session: return report(A, B, al, roots, parents, outfile,
+                                source_delta = source_delta)
   writer = csv.writer(outfile)
   write_header(writer)
   children = cl.invert_dict(parents)
   all_props = set.intersection(set(A.properties), set(B.properties))
-  any_descendant_differs = find_changed_subtrees(roots, children, all_props)
+  any_descendant_differs = find_changed_subtrees(roots, children, all_props,
+                                                 source_delta)
   id_table = assign_ids(parents, roots, children)
 
   def taxon_report(mnode, indent):
@@ -110,7 +171,10 @@ def report(A, B, al, roots, parents, outfile):
     if x and y:
       op = "SHARED"
       ar = al.get(x)
-      comparison = changes.differences(x, y, all_props)    # (drop, change, add)
+      if unchanged(x, y, source_delta):
+        comparison = changes.no_diffs
+      else:
+        comparison = changes.differences(x, y, all_props)    # (drop, change, add)
       if not changes.same(comparison):
         props = changes.unpack(comparison)
         dif = ("; ".join(map(lambda x:x.pet_name, props)))
@@ -157,14 +221,16 @@ def report(A, B, al, roots, parents, outfile):
     report_one_articulation(id, op, nodiff, dif, x, y, z, ar, note, writer, indent)
     return different
 
-  def process(mnode, indent):
+  indents = {root: "" for root in roots}
+  def process(mnode):
+    indent = indents.pop(mnode)
     different = taxon_report(mnode, indent)
     jndent = indent + "—"    # em dash
     if different:
       for child in children.get(mnode, []):
-        process(child, jndent)
-  for root in roots:
-    process(root, "")
+        indents[child] = jndent
+    return different
+  walk(roots, lambda mnode: children.get(mnode, []), pre = process)
 
 def report_one_articulation(id, op, nodiff, dif, x, y, z, ar, note, writer, indent):
   (ix, ux, rankx) = node_data(x)
@@ -198,31 +264,53 @@ def node_data(node):
 # Returns table with True for merged nodes all of whose descendants are
 # unchanged
 
-def find_changed_subtrees(roots, children, all_props):
+def find_changed_subtrees(roots, children, all_props, source_delta = None):
+  # Compare all the shared nodes in one go; the comparisons are
+  # remembered for the report itself
+  shared = [node for node in roots if node[0] and node[1]]
+  for nodes in children.values():
+    shared += [node for node in nodes if node[0] and node[1]]
+  changes.batch_differences([(x, y) for (x, y) in shared
+                             if not unchanged(x, y, source_delta)])
+
   any_descendant_differs = {}
-  def process(node):
+  def process(node, child_changes):
     node_changed = False
     (x, y) = node
     if not x or not y:
       node_changed = True
+    elif unchanged(x, y, source_delta):
+      pass
     else:
       comparison = changes.differences(x, y, all_props)
       if not changes.same(comparison):
         node_changed = True
-    descendant_changed = False
-    for child in children.get(node, []):
-      if process(child):
-        descendant_changed = True
+    descendant_changed = any(child_changes)
     if descendant_changed:
       any_descendant_differs[node] = True
     return descendant_changed or node_changed
-  for root in roots:
-    c = process(root)
+  # Nothing below a pair of identical subtrees has changed
+  def pre(node):
+    (x, y) = node
+    return not (x and y and cl.same_subtree(x, y))
+  changes_at_roots = walk(roots, lambda node: children.get(node, []),
+                          pre = pre, post = process)
+  for (root, c) in zip(roots, changes_at_roots):
     if c: any_descendant_differs[root] = c
   dribble.log("# %s nodes in merge have some change in their descendants" %
               (len(any_descendant_differs)))
   return any_descendant_differs
 
+# True if x and y are the same record in two versions of the same
+# source, unchanged along with its number of children, or if they
+# are the roots of identical subtrees
+
+def unchanged(x, y, source_delta):
+  if cl.same_subtree(x, y): return True
+  if source_delta == None: return False
+  id = cl.get_taxon_id(x)
+  return id == cl.get_taxon_id(y) and source_delta.same(id)
+
 # --------------------
 
 if __name__ == '__main__':
@@ -233,7 +321,32 @@ if __name__ == '__main__':
   parser.add_argument('--high-tag', default="B")
   parser.add_argument('--out', help='file name for report', default='report.csv')
   parser.add_argument('--format', help='report format', default='ad-hoc')
+  parser.add_argument('--cache', action='store_true',
+                      help='reuse (or write) a snapshot of each parsed checklist')
+  parser.add_argument('--mmap', action='store_true',
+                      help='memory-map TSV inputs, decoding fields on demand')
+  parser.add_argument('--project', action='store_true',
+                      help='read only the columns that alignment uses')
+  parser.add_argument('--processes', type=int, default=1,
+                      help='number of worker processes to use')
+  parser.add_argument('--low-root',
+                      help='taxonID of the subtree of low to compare')
+  parser.add_argument('--high-root',
+                      help='taxonID of the subtree of high to compare')
+  parser.add_argument('--save-state',
+                      help='file to save the state of the alignment in')
+  parser.add_argument('--previous-state',
+                      help='state saved by an earlier run, to align incrementally')
+  parser.add_argument('--previous-low',
+                      help='low checklist of the earlier run, if different')
+  parser.add_argument('--previous-high',
+                      help='high checklist of the earlier run, if different')
+  parser.add_argument('--same-source', action='store_true',
+                      help='low and high are versions of one source; skip unchanged records')
   args = parser.parse_args()
   main(args.low, args.low_tag, args.high, args.high_tag,
-       args.out, args.format)
+       args.out, args.format, args.cache, args.mmap, args.project,
+       args.processes, args.low_root, args.high_root,
+       args.save_state, args.previous_state,
+       args.previous_low, args.previous_high, args.same_source)
 
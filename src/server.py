@@ -0,0 +1,189 @@
+#!/bin/env python3
+
+# Comparison server.  Reference checklists (e.g. the GBIF backbone, an
+# NCBI release) are read once, at startup, and stay in memory; each
+# request uploads a small checklist, which is aligned against one of
+# them and reported on in one of the report.py formats.
+
+#   python3 src/server.py --ref gbif=work/gbif/primates.csv --port 8400
+#   curl --data-binary @my-list.csv 'http://localhost:8400/compare?ref=gbif'
+
+# Query parameters for POST /compare:
+#   ref     name of a reference checklist (required)
+#   root    taxonID of the subtree of the reference to compare against
+#           (default: all of it)
+#   format  report format, as for report.py (default ad-hoc)
+#   type    csv or tsv, the upload's format (default csv)
+#   upload  high (default) if the upload has priority over the
+#           reference, low if the reference has priority
+# GET / lists the reference checklists.
+
+# Each request runs in its own session (see session.py) made from the
+# session holding the references, so nothing read or computed for a
+# request outlives it.  What depends only on a reference is made once
+# and kept with it: its match indexes, subtree hash index and record
+# fingerprints, and for each root asked for, the scope of that
+# subtree (with its own).  So aligning does work in proportion to the
+# upload and the parts of the reference it matches.  The report does
+# not: in the ad-hoc format it lists every node of the reference (or
+# of the root's subtree).
+
+import os, io, csv, tempfile, traceback, threading
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import checklist as cl
+import alignment
+import changes
+import report
+import dribble
+from session import Session
+
+references = {}                 # name -> checklist
+scopes = {}                     # (name, root taxonID) -> scope
+scopes_lock = threading.Lock()
+base_session = Session()
+
+def load_references(specs, cache = False, mapped = False, projection = None):
+  with base_session:
+    for spec in specs:
+      (name, path) = spec.split("=", 1)
+      dribble.log("# Loading reference %s from %s" % (name, path))
+      R = cl.read_checklist(path, name + ".", name,
+                            cache, mapped, projection)
+      prepare(R)
+      references[name] = R
+
+# Build, ahead of any request and in the base session, what aligning
+# against a reference (or scope) and reporting on it use
+
+def prepare(R):
+  for prop in cl.match_properties:
+    cl.index_by_value(R, prop)
+  R.get_hash_index()
+  for column in R.columns:
+    if column != None: changes.get_materialized(column)
+  changes.get_fingerprints(R)
+  changes.get_child_counts(R)
+
+# The scope of a reference below root, made in the base session the
+# first time it's asked for
+
+def get_scope(ref, root):
+  with scopes_lock:
+    view = scopes.get((ref, root))
+    if view == None:
+      with base_session:
+        view = cl.make_scope(references[ref], root)
+        prepare(view)
+      scopes[(ref, root)] = view
+  return view
+
+# Align the uploaded checklist (in a file) with a reference, and
+# return the report as a string
+
+def compare(inpath, ref, format = "ad-hoc", upload = "high",
+            projection = None, root = None):
+  with Session(base_session) as session:
+    session.dribble_file = io.StringIO()
+    try:
+      U = cl.read_checklist(inpath, "upload.", "upload",
+                            projection = projection)
+    except AssertionError:
+      # read_checklist checks its input with assertions
+      raise ValueError("not a usable checklist (is a column missing?)")
+    if root:
+      R = cl.use_scope(get_scope(ref, root))
+    else:
+      R = references[ref]
+    if upload == "high":
+      (A, B) = (R, U)
+    else:
+      (A, B) = (U, R)
+    (al, xmrcas) = alignment.align(B, A)
+    (fd, outpath) = tempfile.mkstemp(suffix = "." + format)
+    os.close(fd)
+    try:
+      report.write_report(A, B, al, xmrcas, format, outpath)
+      with open(outpath, "r", newline = "") as outfile:
+        return outfile.read()
+    finally:
+      os.remove(outpath)
+
+class Handler(BaseHTTPRequestHandler):
+  projection = None
+
+  def do_GET(self):
+    if urlparse(self.path).path != "/":
+      self.reply(404, "No such resource\n")
+      return
+    self.reply(200, "".join("%s\t%s\n" % (name, len(R.get_all_nodes()))
+                            for (name, R) in references.items()))
+
+  def do_POST(self):
+    url = urlparse(self.path)
+    if url.path != "/compare":
+      self.reply(404, "No such resource\n")
+      return
+    params = {key: values[-1] for (key, values) in parse_qs(url.query).items()}
+    ref = params.get("ref")
+    if not ref in references:
+      self.reply(404, "No such reference checklist: %s\n" % ref)
+      return
+    suffix = params.get("type", "csv")
+    upload = params.get("upload", "high")
+    if not suffix in ("csv", "tsv") or not upload in ("high", "low"):
+      self.reply(400, "Bad type or upload parameter\n")
+      return
+    length = int(self.headers.get("Content-Length", 0))
+    (fd, inpath) = tempfile.mkstemp(suffix = "." + suffix)
+    try:
+      with os.fdopen(fd, "wb") as infile:
+        infile.write(self.rfile.read(length))
+      result = compare(inpath, ref, params.get("format", "ad-hoc"), upload,
+                       self.projection, params.get("root"))
+    except (ValueError, csv.Error) as e:
+      # Bad upload (includes UnicodeDecodeError) or unknown root
+      self.reply(400, "Comparison failed: %r\n" % (e,))
+      return
+    except Exception as e:
+      self.log_error("Comparison failed: %r", e)
+      traceback.print_exc()
+      self.reply(500, "Internal error: %r\n" % (e,))
+      return
+    finally:
+      os.remove(inpath)
+    self.reply(200, result)
+
+  def reply(self, status, text):
+    body = text.encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "text/plain; charset=utf-8")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+def main(refs, host, port, cache = False, mapped = False, project = False):
+  projection = set(cl.alignment_properties) if project else None
+  load_references(refs, cache, mapped, projection)
+  Handler.projection = projection
+  server = ThreadingHTTPServer((host, port), Handler)
+  dribble.log("# Serving %s reference checklist(s) on %s:%s" %
+              (len(references), host, port))
+  server.serve_forever()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--ref', action='append', default=[],
+                      help='reference checklist, as NAME=PATH (repeatable)')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8400)
+  parser.add_argument('--cache', action='store_true',
+                      help='reuse (or write) a snapshot of each reference')
+  parser.add_argument('--mmap', action='store_true',
+                      help='memory-map TSV references, decoding fields on demand')
+  parser.add_argument('--project', action='store_true',
+                      help='read only the columns that alignment uses')
+  args = parser.parse_args()
+  main(args.ref, args.host, args.port, args.cache, args.mmap, args.project)
@@ -0,0 +1,72 @@
+# A session holds the state shared by the checklists of one comparison
+# (or of several): the registry that maps uids to checklists, the
+# caches of record comparisons and cross-checklist joins, and the log
+# file.  Dropping a session frees everything that was loaded into it.
+
+# The current session is per thread.  Use a session with 'with':
+#   with Session() as s:
+#     A = cl.read_checklist(...)
+# read_checklist, alignment.align, merge.merge_checklists and the report
+# writers also take an optional session argument, which they make
+# current while they run.  Outside of any 'with', the default session
+# is used.
+
+# A session made from a base session starts out with the base's
+# checklists, under the same uids, and with what the base has cached
+# about each of them alone (record fingerprints, decoded columns,
+# child counts).  Its other caches, which are about pairs of records
+# or of checklists, are its own.  So reference checklists can be
+# loaded (and prepared) once in a base session, and each comparison
+# done in its own session made from that one.  Checklists loaded into
+# the base afterwards are not seen.
+
+import threading
+
+class Session:
+  def __init__(self, base = None):
+    # Registry (see table.py)
+    if base:
+      self.first_uids = list(base.first_uids)
+      self.tables = list(base.tables)
+      self.next_uid = base.next_uid
+    else:
+      self.first_uids = [0]
+      self.tables = [None]
+      self.next_uid = 1
+    # Caches (see changes.py and articulation.py)
+    self.comparisons = {}
+    self.column_pairs = {}
+    if base:
+      self.fingerprints = dict(base.fingerprints)
+      self.materialized = dict(base.materialized)
+      self.child_counts = dict(base.child_counts)
+    else:
+      self.fingerprints = {}
+      self.materialized = {}
+      self.child_counts = {}
+    self.joins = {}
+    # Log file (see dribble.py)
+    self.dribble_file = None
+
+  def __enter__(self):
+    local.stack.append(local.current)
+    local.current = self
+    return self
+
+  def __exit__(self, *exc_info):
+    local.current = local.stack.pop()
+
+# Each thread has its own current session, and the sessions it left
+# behind by entering that one.  current() is called for nearly every
+# record access, so it is a single attribute fetch.
+
+class Local(threading.local):
+  def __init__(self):
+    self.stack = []
+    self.current = default
+
+def current():
+  return local.current
+
+default = Session()
+local = Local()
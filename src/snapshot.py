@@ -0,0 +1,165 @@
+# Binary snapshots of loaded checklists.
+
+# A snapshot holds everything read_checklist computes - the parsed
+# columns, indexes, topology, sequence numbers, ancestry index and
+# subtree hashes - so that a second load of the same input skips
+# parsing and validation.
+# It is stored next to the input and is keyed by the input's path,
+# size and content hash, and by the projection (if any) used to read it.
+
+import os, io, pickle, hashlib, tempfile
+import multiprocessing
+from array import array
+
+import checklist as cl
+import table
+import dribble
+import archive
+import session
+
+version = 6
+
+# For a member of a zip archive, the snapshot goes next to the archive
+
+def snapshot_path(inpath):
+  (zip_path, member) = archive.split_path(inpath)
+  if zip_path == None:
+    return inpath + ".snapshot"
+  return "%s-%s.snapshot" % (zip_path, (member or "core").replace("/", "-"))
+
+# Fields of a Checklist that hold uids (as opposed to local numbers,
+# codes, or sequence numbers).  These need adjusting if the checklist
+# is loaded at a different place in the uid space than where it was
+# saved.
+
+uid_arrays = ["parents", "accepteds",
+              "first_child", "next_sibling",
+              "first_synonym", "next_synonym",
+              "nodes_by_sequence"]
+
+def content_hash(inpath):
+  h = hashlib.blake2b(digest_size=16)
+  with open(inpath, "rb") as infile:
+    while True:
+      chunk = infile.read(1 << 20)
+      if not chunk: break
+      h.update(chunk)
+  return h.hexdigest()
+
+def projection_key(projection):
+  if projection == None: return None
+  return sorted(prop.pet_name for prop in projection)
+
+# The key is computed from the file holding the input, i.e. the
+# archive if it's in one
+
+def save(checklist, inpath):
+  outpath = snapshot_path(inpath)
+  source = archive.container(inpath)
+  key = (version, os.path.abspath(inpath), os.path.getsize(source),
+         content_hash(source), projection_key(checklist.projection))
+  write(checklist, outpath, key)
+  dribble.log("# Wrote snapshot %s" % outpath)
+
+# Returns None if there is no usable snapshot for inpath.  A snapshot
+# that can't be read (truncated, or in an old format) is as good as
+# none.
+
+def load(inpath, prefix, name, projection = None):
+  path = snapshot_path(inpath)
+  if not os.path.exists(path): return None
+  try:
+    with open(path, "rb") as infile:
+      key = pickle.load(infile)
+      source = archive.container(inpath)
+      if (key[0] != version or
+          key[1] != os.path.abspath(inpath) or
+          key[2] != os.path.getsize(source) or
+          key[4] != projection_key(projection) or
+          key[3] != content_hash(source)):
+        dribble.log("# Snapshot %s is stale" % path)
+        return None
+      state = pickle.load(infile)
+    checklist = restore(state, prefix, name, projection)
+  except Exception as e:
+    dribble.log("# Snapshot %s is unreadable (%r)" % (path, e))
+    return None
+  dribble.log("# Loaded %s records from snapshot %s" %
+              (len(checklist.record_uids), path))
+  return checklist
+
+# The file holds a key followed by the checklist's state
+
+def write(checklist, outpath, key):
+  state = dict(checklist.__dict__)
+  del state["prefix"]
+  del state["name"]
+  del state["indexing"]
+  del state["roots"]
+  del state["hash_index"]
+  state["columns"] = [column and column.materialize()
+                      for column in checklist.columns]
+  with open(outpath + ".new", "wb") as outfile:
+    pickle.dump(key, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.dump(state, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(outpath + ".new", outpath)
+
+def restore(state, prefix, name, projection):
+  checklist = cl.Checklist(prefix, name, projection)
+  checklist.__dict__.update(state)
+  saved_offset = checklist.uid_offset
+  checklist.record_uids = table._register(checklist, len(checklist.record_uids))
+  rebase(checklist, checklist.uid_offset - saved_offset)
+  return checklist
+
+def rebase(checklist, delta):
+  if delta == 0: return
+  def shift(uids):
+    return array('I', (uid + delta if uid else 0 for uid in uids))
+  for field in uid_arrays:
+    setattr(checklist, field, shift(getattr(checklist, field)))
+  checklist.jumps = [shift(jump) for jump in checklist.jumps]
+  for i in range(len(checklist.indexes)):
+    index = checklist.indexes[i]
+    if index != None:
+      checklist.indexes[i] = \
+        {value: [uid + delta for uid in uids] for (value, uids) in index.items()}
+
+# ---------- Loading several checklists at once
+
+# Read each (specifier, prefix, name) in its own worker process.  A
+# worker hands its checklist back as a snapshot file: the cached one
+# next to the input if cache is true, otherwise a temporary file.
+
+def read_checklists_in_parallel(requests, cache = False, mapped = False,
+                                projection = None):
+  dribble_file = session.current().dribble_file
+  if dribble_file: dribble_file.flush()
+  jobs = [(specifier, prefix, name, cache, mapped, projection)
+          for (specifier, prefix, name) in requests]
+  with multiprocessing.Pool(len(jobs)) as pool:
+    results = pool.map(read_in_worker, jobs)
+  checklists = []
+  for ((specifier, prefix, name), (path, log)) in zip(requests, results):
+    # The worker printed its commentary; it still belongs in the log
+    if dribble_file: dribble_file.write(log)
+    with open(path, "rb") as infile:
+      pickle.load(infile)       # key
+      checklists.append(restore(pickle.load(infile), prefix, name, projection))
+    if not cache: os.remove(path)
+  return checklists
+
+def read_in_worker(job):
+  (specifier, prefix, name, cache, mapped, projection) = job
+  with session.Session() as worker_session:
+    worker_session.dribble_file = io.StringIO()
+    checklist = cl.read_checklist(specifier, prefix, name,
+                                  cache, mapped, projection)
+    if cache:
+      path = snapshot_path(specifier)
+    else:
+      (fd, path) = tempfile.mkstemp(suffix=".snapshot")
+      os.close(fd)
+      checklist.build_indexes([cl.taxon_id] + cl.match_properties)
+      write(checklist, path, None)
+    return (path, worker_session.dribble_file.getvalue())
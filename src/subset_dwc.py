@@ -1,7 +1,12 @@
 """
  Makes a subset of a checklist based on one subtree of a taxonmoy.
 
- python3 subset_dwc.py [--taxonomy tax_dwc] source_dwc out_dwc
+ python3 subset_dwc.py [--taxonomy tax_dwc] source_dwc id --out out_dwc
+
+ or several subsets at once, with one pass over the taxonomy and one
+ over the checklist:
+
+ python3 subset_dwc.py [--taxonomy tax_dwc] source_dwc --batch id=out_dwc ...
 
  Assumption: every accepted record has a taxonID
 """
@@ -9,17 +14,34 @@
 debug = False
 
 import sys, os, csv, argparse
+import contextlib
+import archive
+from traversal import walk
 
 def main(checklist, tax_path, root_id, outpath):
+  main_batch(checklist, tax_path, [(root_id, outpath)])
+
+# subsets is a list of (root_id, outpath)
+
+def main_batch(checklist, tax_path, subsets):
   topo = read_topology(tax_path)
-  all = closure(topo, root_id)
-  write_subset(checklist, root_id, all, topo, outpath)
+  # taxon id -> positions in subsets of the subsets it belongs to
+  memberships = {}
+  for (i, (root_id, outpath)) in enumerate(subsets):
+    for tid in closure(topo, root_id):
+      if tid in memberships:
+        memberships[tid].append(i)
+      else:
+        memberships[tid] = [i]
+  write_subsets(checklist, memberships,
+                [outpath for (root_id, outpath) in subsets], topo)
 
-def write_subset(checklist, root_id, all, topo, outpath):
-  print("Writing subset to %s" % outpath, flush=True)
+def write_subsets(checklist, memberships, outpaths, topo):
+  for outpath in outpaths:
+    print("Writing subset to %s" % outpath, flush=True)
 
-  (delimiter, quotechar, mode) = csv_parameters(checklist)
-  with open(checklist, "r") as infile:
+  (delimiter, quotechar, mode) = archive.csv_parameters(checklist)
+  with archive.open_text(checklist) as infile:
     reader = csv.reader(infile, delimiter=delimiter, quotechar=quotechar, quoting=mode)
     head = next(reader)
 
@@ -28,41 +50,43 @@ def write_subset(checklist, root_id, all, topo, outpath):
     pid_column = head.index("parentNameUsageID")
     sid_column = head.index("taxonomicStatus")
 
-    with open(outpath, "w") as outfile:
-      (delimiter, quotechar, mode) = csv_parameters(outpath)
-      writer = csv.writer(outfile, delimiter=delimiter, quotechar=quotechar, quoting=mode)
-      writer.writerow(head)
+    with contextlib.ExitStack() as stack:
+      writers = []
+      for outpath in outpaths:
+        outfile = stack.enter_context(open(outpath, "w"))
+        (delimiter, quotechar, mode) = csv_parameters(outpath)
+        writer = csv.writer(outfile, delimiter=delimiter, quotechar=quotechar, quoting=mode)
+        writer.writerow(head)
+        writers.append(writer)
       for row in reader:
         row = clean(row, tid_column, pid_column, aid_column, sid_column, topo)
         tid = row[tid_column]
-        if tid in all:
-          writer.writerow(row)
+        for i in memberships.get(tid, ()):
+          writers[i].writerow(row)
 
 # Transitive closure of accepted records
 
 def closure(topo, root_id):
   print("Computing transitive closure starting from %s" % root_id, flush=True)
   all = {}
-  empty = []
   def descend(id):
-    if not id in all:
-      all[id] = True
-      if id in topo:
-        (children, synonyms, _) = topo[id]
-        for child in children:
-          descend(child)
-        for syn in synonyms:
-          descend(syn)
-  descend(root_id)
+    if id in all: return False
+    all[id] = True
+  def inferiors(id):
+    if id in topo:
+      (children, synonyms, _) = topo[id]
+      return children + synonyms
+    return []
+  walk([root_id], inferiors, pre = descend)
   print ("  Nodes in transitive closure: %s" % len(all))
   return all
 
 def read_topology(tax_path):
   # Keyed by taxon id
   topo = {}
-  (delimiter, quotechar, mode) = csv_parameters(tax_path)
+  (delimiter, quotechar, mode) = archive.csv_parameters(tax_path)
   counter = 0
-  with open(tax_path, "r") as infile:
+  with archive.open_text(tax_path) as infile:
     print("Scanning %s to obtain topology" % tax_path, flush=True)
     reader = csv.reader(infile, delimiter=delimiter, quotechar=quotechar, quoting=mode)
     head = next(reader)
@@ -214,7 +238,19 @@ if __name__ == '__main__':
   parser.add_argument('--taxonomy', help="""taxonomy from which to extract
                             hierarchy; defaults to source""")
   parser.add_argument('source', help='taxonomy or checklist from which to extract subset')
-  parser.add_argument('id', help="taxon id of subset's root")
+  parser.add_argument('id', nargs='?', help="taxon id of subset's root")
   parser.add_argument('--out', help='where to store the subset')
+  parser.add_argument('--batch', action='append', default=[], metavar='ID=OUT',
+                      help='also extract the subset rooted at ID into OUT (repeatable)')
   args = parser.parse_args()
-  main(args.source, args.taxonomy or args.source, args.id, args.out)
+  subsets = [tuple(spec.split("=", 1)) for spec in args.batch]
+  if args.id != None:
+    if not args.out:
+      parser.error("an id needs --out")
+    subsets.insert(0, (args.id, args.out))
+  elif args.out != None:
+    parser.error("--out needs an id")
+  if len(subsets) == 0 or any(len(subset) != 2 or not all(subset)
+                              for subset in subsets):
+    parser.error("give an id (with --out), or --batch ID=OUT")
+  main_batch(args.source, args.taxonomy or args.source, subsets)
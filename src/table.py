@@ -1,14 +1,129 @@
 import csv
+import array
+import bisect
+import mmap
+import threading
 import property
+import session
+import archive
 
 # A table can be read and/or written
 # If a table is populated it can be indexed
 # The columns of a table have labels
 
-class Table:
+# Storage is columnar.  Each table owns a contiguous run of record
+# uids; a record's position within the run is its 'local' number
+# (1-based; local 0 is unused so that 0 can mean 'no record').  For
+# each recognized property there is a Column holding one small integer
+# code per record.  Codes index into the column's list of distinct
+# values (code 0 = no value), so a string that occurs in many records
+# is stored only once.
+
+class Column:
   def __init__(self):
+    self.values = [None]          # code -> value
+    self.codes_by_value = {}      # value -> code
+    self.codes = array.array('I', [0])    # local -> code
+
+  def append(self, value):
+    if value == '' or value == None:
+      self.codes.append(0)
+      return
+    code = self.codes_by_value.get(value)
+    if code == None:
+      code = len(self.values)
+      self.values.append(value)
+      self.codes_by_value[value] = code
+    self.codes.append(code)
+
+  def get(self, local):
+    return self.values[self.codes[local]]
+
+  # An index maps value -> list of uids, keys in order of first
+  # occurrence.  indexer returns (step, finish): call step(local) for
+  # each record in order, then finish() to get the index.
+
+  def indexer(self, uid_offset):
+    uids_by_code = [[] for value in self.values]
+    codes = self.codes
+    def step(local):
+      code = codes[local]
+      if code:
+        uids_by_code[code].append(uid_offset + local)
+    def finish():
+      return {self.values[code]: uids_by_code[code]
+              for code in range(1, len(uids_by_code))}
+    return (step, finish)
+
+  # Array of function(value) for each record.  function is applied
+  # once per distinct value, and must map None to 0.
+
+  def map_to_ints(self, function):
+    results = [function(value) for value in self.values]
+    return array.array('I', (results[code] for code in self.codes))
+
+  def materialize(self):
+    return self
+
+  # The reverse mapping is rebuilt rather than stored
+
+  def __getstate__(self):
+    return (self.values, self.codes)
+
+  def __setstate__(self, state):
+    (self.values, self.codes) = state
+    self.codes_by_value = {self.values[code]: code
+                           for code in range(1, len(self.values))}
+
+# A column of a memory-mapped TSV file.  Only the location of each
+# field is kept (offset of the row in the file, offset of the field in
+# the row, and length); the text is decoded when it is fetched.
+
+class MappedColumn:
+  def __init__(self, mapped, row_starts):
+    self.mapped = mapped            # mmap of the whole file
+    self.row_starts = row_starts    # local -> offset of row, shared
+    self.starts = array.array('I', [0])   # local -> offset within row
+    self.lengths = array.array('I', [0])  # local -> length in bytes
+
+  def get(self, local):
+    length = self.lengths[local]
+    if length == 0: return None
+    start = self.row_starts[local] + self.starts[local]
+    return self.mapped[start : start + length].decode('utf-8')
+
+  def indexer(self, uid_offset):
+    index = {}
+    def step(local):
+      value = self.get(local)
+      if value != None:
+        if value in index:
+          index[value].append(uid_offset + local)
+        else:
+          index[value] = [uid_offset + local]
+    return (step, lambda: index)
+
+  def map_to_ints(self, function):
+    return array.array('I', [function(self.get(local))
+                             for local in range(len(self.lengths))])
+
+  # Convert to an ordinary Column (e.g. for pickling)
+
+  def materialize(self):
+    column = Column()
+    for local in range(1, len(self.lengths)):
+      column.append(self.get(local))
+    return column
+
+# If projection (a collection of properties) is given, only those
+# columns are kept; the others are discarded as the table is read.
+
+class Table:
+  def __init__(self, projection = None):
     self.record_uids = []
-    pass
+    self.uid_offset = None      # uid = uid_offset + local
+    self.projection = projection
+    self.indexing = None        # background indexing thread, if any
 
   def header(self):
     return self.header
@@ -22,55 +137,129 @@ class Table:
     assert not "," in header[0]
     self.header = header
     self.position_index = [None] * property.number_of_properties
-    self.methods = [not_present] * property.number_of_properties
+    self.columns = [None] * property.number_of_properties
     # TBD: If there is a meta.xml, get the properties that way.
     # NB: by_name returns None if label is unrecognized
     self.properties = [property.by_name(label) for label in header]
+    if self.projection != None:
+      self.properties = [prop if prop in self.projection else None
+                         for prop in self.properties]
     self.indexes = [None] * property.number_of_properties
     for position in range(len(header)):
       # position is column position within record (table specific)
       prop = self.properties[position]
       if prop:
         self.position_index[prop.uid] = position
-        self.methods[prop.uid] = self.fetcher(prop, position)
+        self.columns[prop.uid] = Column()
 
-  def fetcher(self, prop, position):
-    def fetch(r):
-      if r[position] == '': return None
-      return r[position]
-    return fetch
+  # Unrecognized columns are dropped here; nothing could fetch them.
 
   def populate_from_generator(self, record_generator):
     self.process_header(next(record_generator))
+    # If a property occurs twice in the header, the last column wins
+    loaders = [(position, self.columns[uid])
+               for (uid, position) in enumerate(self.position_index)
+               if position != None]
+    count = 0
     for record in record_generator:
-      id = _register(record, self)
-      self.record_uids.append(id)
+      for (position, column) in loaders:
+        column.append(record[position])
+      count += 1
+    self.record_uids = _register(self, count)
+
+  # With mapped = True, a TSV file is memory-mapped rather than read
+  # through csv.reader (see MappedColumn).  CSV files, which can have
+  # quoted fields, are always read the ordinary way.
 
-  def populate_from_file(self, inpath):
-    # Look for a meta.xml file in same directory?
-    (delim, qc, qu) = csv_parameters(inpath)
+  # inpath can also be a member of a zip archive, or a Darwin Core
+  # archive (see archive.py).  Those are streamed, not mapped.
+
+  def populate_from_file(self, inpath, mapped = False):
+    (delim, qc, qu) = archive.csv_parameters(inpath)
+    if mapped and qu == csv.QUOTE_NONE and not archive.is_archived(inpath):
+      self.populate_from_mapped_file(inpath, delim)
+      return
     # print("# Parameters %s %s %s" % (delim, qc, qu))
-    with open(inpath, "r") as infile:
+    with archive.open_text(inpath) as infile:
       reader = csv.reader(infile, delimiter=delim, quotechar=qc, quoting=qu)
       self.populate_from_generator(reader)
 
+  def populate_from_mapped_file(self, inpath, delim):
+    with open(inpath, "rb") as infile:
+      mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    delim = delim.encode('utf-8')
+    size = len(mapped)
+    end = mapped.find(b"\n")
+    if end < 0: end = size
+    self.process_header(mapped[:end].rstrip(b"\r").decode('utf-8').split("\t"))
+    row_starts = array.array('Q', [0])
+    loaders = []
+    for (uid, position) in enumerate(self.position_index):
+      if position != None:
+        self.columns[uid] = MappedColumn(mapped, row_starts)
+        loaders.append((position, self.columns[uid]))
+    pos = end + 1
+    while pos < size:
+      end = mapped.find(b"\n", pos)
+      if end < 0: end = size
+      line = mapped[pos:end]
+      if line.endswith(b"\r"): line = line[:-1]
+      if line:
+        row_starts.append(pos)
+        fields = line.split(delim)
+        starts = []
+        start = 0
+        for field in fields:
+          starts.append(start)
+          start += len(field) + 1
+        for (position, column) in loaders:
+          column.starts.append(starts[position])
+          column.lengths.append(len(fields[position]))
+      pos = end + 1
+    self.record_uids = _register(self, len(row_starts) - 1)
+
   # Create indexes on demand.  Position is column position specific to
   # this table, which can be determined using get_position.
 
   def get_index(self, prop):
-    if self.methods[prop.uid] == not_present: return {}
+    column = self.columns[prop.uid]
+    if column == None: return {}
     if self.indexes[prop.uid] == None:
-      index = {}
-      for id in self.record_uids:
-        value = get_value(id, prop)
-        if value != None:
-          if value in index:
-            index[value].append(id)
-          else:
-            index[value] = [id]
-      self.indexes[prop.uid] = index
+      self.finish_indexing()
+      if self.indexes[prop.uid] == None:
+        self.build_indexes([prop])
     return self.indexes[prop.uid]
 
+  # Build the indexes for all of the given properties in a single pass
+  # over the records.
+
+  def build_indexes(self, props):
+    builders = []
+    for prop in props:
+      column = self.columns[prop.uid]
+      if column != None and self.indexes[prop.uid] == None:
+        builders.append((prop, column.indexer(self.uid_offset)))
+    if not builders: return
+    steps = [step for (_, (step, _)) in builders]
+    for local in range(1, len(self.record_uids) + 1):
+      for step in steps:
+        step(local)
+    for (prop, (_, finish)) in builders:
+      self.indexes[prop.uid] = finish()
+
+  # Build indexes in a background thread.  get_index waits for it.
+  # The thread touches only this table's columns, not the registry.
+
+  def start_indexing(self, props):
+    self.finish_indexing()
+    self.indexing = threading.Thread(target=self.build_indexes, args=(props,))
+    self.indexing.start()
+
+  def finish_indexing(self):
+    if self.indexing != None:
+      self.indexing.join()
+      self.indexing = None
+
 def csv_parameters(path):
   if ".csv" in path:
     return (",", '"', csv.QUOTE_MINIMAL)
@@ -87,30 +276,49 @@ def read_table(specifier):
 def is_record(x):
   return isinstance(x, int) and x > 0
 
-_registry = ["there is no record 0"]
+# The registry, which belongs to the current session, maps a uid to
+# the table that owns it.  Tables are registered in uid order, so
+# first_uids is sorted and the owner is found by bisection.  Uid 0 is
+# not a record.
+
+def _register(table, count):    # returns the table's uids
+  s = session.current()
+  first = s.next_uid
+  s.next_uid += count
+  table.uid_offset = first - 1
+  s.first_uids.append(first)
+  s.tables.append(table)
+  return range(first, s.next_uid)
 
-# We store a pair (record, table) where table is the table that "owns"
-# the record.
+# Make other stand for table (or whatever stands for it now) in the
+# registry (see checklist.Scope)
 
-def record_and_table(record_uid):    # returns (record, table)
-  return _registry[record_uid]
+def _substitute(table, other):
+  s = session.current()
+  s.tables[bisect.bisect_right(s.first_uids, table.uid_offset + 1) - 1] = other
 
-def _register(record, table):
-  record_uid = len(_registry)
-  _registry.append((record, table))
-  return record_uid
+# These two are called for nearly every record access, so they fetch
+# the current session directly instead of calling session.current()
 
-def not_present(record):
-  return None
+_session_local = session.local
 
 def get_value(record_uid, prop):
-  (r, t) = record_and_table(record_uid)
-  val = t.methods[prop.uid](r)
-  return val
+  s = _session_local.current
+  t = s.tables[bisect.bisect_right(s.first_uids, record_uid) - 1]
+  column = t.columns[prop.uid]
+  if column == None: return None
+  return column.get(record_uid - t.uid_offset)
 
 def get_table(record_uid):
-  (r, t) = record_and_table(record_uid)
-  return t
+  s = _session_local.current
+  return s.tables[bisect.bisect_right(s.first_uids, record_uid) - 1]
+
+# Reconstitute a record (recognized columns only) as a list
+
+def get_record(record_uid):
+  t = get_table(record_uid)
+  return [get_value(record_uid, prop) if prop else None
+          for prop in t.properties]
 
 # ---------- Self-test
 
@@ -124,8 +332,7 @@ def self_test():
   print ("taxonID position in properties is %s" % prop.uid)
 
   rec = table.record_uids[0]
-  (r, _) = record_and_table(rec)
-  print ("Sample record: %s" % r)
+  print ("Sample record: %s" % get_record(rec))
   print ("Taxon id of sample record: %s" % get_value(rec, prop))
 
   idx = table.get_index(prop)
@@ -0,0 +1,35 @@
+# Tree traversal with an explicit stack, so that deep lineages don't
+# run into the recursion limit.
+
+# Walk the trees rooted at each of roots, depth first.
+#   get_children(node) gives the node's children, in order.
+#   pre(node), if given, is called when the node is first reached
+#     (preorder).  If it returns False the node's descendants are
+#     skipped.
+#   post(node, results), if given, is called after all of the node's
+#     descendants have been visited (postorder).  results is the list
+#     of values that post returned for the node's children.
+# Returns the list of values that post returned for the roots.
+
+def walk(roots, get_children, pre = None, post = None):
+  def enter(node):
+    if pre and pre(node) == False:
+      return [node, (), 0, []]
+    return [node, get_children(node), 0, []]
+  top = []
+  for root in roots:
+    stack = [enter(root)]
+    while stack:
+      frame = stack[-1]
+      (node, children, i, results) = frame
+      if i < len(children):
+        frame[2] = i + 1
+        stack.append(enter(children[i]))
+      else:
+        stack.pop()
+        value = post(node, results) if post else None
+        if stack:
+          stack[-1][3].append(value)
+        else:
+          top.append(value)
+  return top